@@ -1,4 +1,3 @@
 cd asm
-python3 assemble_us.py
-python3 assemble_jp.py
+python3 assemble.py
 cd ..
\ No newline at end of file
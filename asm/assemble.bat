@@ -1,2 +1 @@
-py -3.8 assemble_us.py
-py -3.8 assemble_jp.py
+py -3.8 assemble.py
@@ -0,0 +1,1339 @@
+import argparse
+import glob
+import re
+from subprocess import check_output
+import os
+import tempfile
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import yaml
+import time
+import traceback
+
+import sys
+
+sys.path.insert(0, "../sslib")
+from fs_helpers import *
+from elf import *
+from to_lst import get_lst_symbols
+from build_cache import BuildCache, hash_inputs, hash_file
+from rust_builder import RustBuilder, fingerprint_rust_crate
+from rel_builder import RelBuilder, build_rel
+from dependency_graph import DependencyGraph, hash_input_files
+from patch_diff import write_patch_diff
+from patch_parser import PatchChunks
+from symbol_store import load_symbol_table, symbol_cache
+from linker_script import LinkerScriptBuilder, get_symbols_linker_script
+from link_map import read_link_map
+from profiler import profiler
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is optional. Without it, local relocations are applied one at a time.
+    numpy = None
+
+if sys.platform == "win32":
+    devkitbasepath = r"C:\devkitPro\devkitPPC\bin"
+else:
+    if not "DEVKITPPC" in os.environ:
+        raise Exception(
+            r"Could not find devkitPPC. Path to devkitPPC should be in the DEVKITPPC env var."
+        )
+    devkitbasepath = os.environ.get("DEVKITPPC") + "/bin"
+
+
+def get_bin(name):
+    if not sys.platform == "win32":
+        return os.path.join(devkitbasepath, name)
+    return os.path.join(devkitbasepath, name + ".exe")
+
+
+if not os.path.isfile(get_bin("powerpc-eabi-as")):
+    raise Exception(
+        r"Failed to assemble code: Could not find devkitPPC. devkitPPC should be installed to: C:\devkitPro\devkitPPC."
+    )
+
+# Cached chunk outputs are only valid for the toolchain that produced them.
+toolchain_version = hash_inputs(
+    check_output([get_bin("powerpc-eabi-as"), "--version"]),
+    check_output([get_bin("powerpc-eabi-ld"), "--version"]),
+)
+# Bump this whenever the way chunks are assembled, linked or read back changes, so old cached chunks are ignored.
+CHUNK_CACHE_FORMAT = 1
+# Enough for every chunk of every version a few times over.
+CHUNK_CACHE_MAX_ENTRIES = 4096
+chunk_cache = BuildCache("chunks", max_entries=CHUNK_CACHE_MAX_ENTRIES)
+rust_builder = RustBuilder("./custom-functions")
+rel_builder = RelBuilder(get_bin("powerpc-eabi-ld"), "merge.ld", toolchain_version)
+
+# Allow yaml to dump OrderedDicts for the custom symbols.
+yaml.CDumper.add_representer(
+    OrderedDict, lambda dumper, data: dumper.represent_dict(data.items())
+)
+
+# Output integers as hexadecimal.
+yaml.CDumper.add_representer(
+    int, lambda dumper, data: yaml.ScalarNode("tag:yaml.org,2002:int", "0x%02X" % data)
+)
+
+with open("version_config.yaml") as f:
+    VERSION_CONFIGS = yaml.safe_load(f)
+
+
+# The code that generates each kind of output, so that changing it makes the outputs out of date for --incremental.
+PATCH_OUTPUT_GENERATORS = [
+    "assemble.py",
+    "elf.py",
+    "fs_helpers.py",
+    "link_map.py",
+    "linker_script.py",
+    "patch_diff.py",
+    "patch_parser.py",
+    "symbol_store.py",
+]
+CUSTOM_REL_GENERATORS = [
+    "assemble.py",
+    "fs_helpers.py",
+    "lst_file.py",
+    "rel_builder.py",
+    "relmapper.py",
+    "symbol_store.py",
+    "to_lst.py",
+]
+
+
+class UndefinedChunkSymbolsError(Exception):
+    # A chunk linked alongside others in the same wave was left with undefined symbols, which linking the chunks one at a time might resolve.
+    pass
+
+
+def get_code_and_relocations_from_elf(
+    bin_name, org_offset, allow_undefined_symbols=True
+):
+    # Only .text and its relocations are needed, so let the rest of the ELF stay undecoded.
+    elf = ELF()
+    elf.read_from_file(bin_name, lazy=True)
+
+    code = None
+    relocations_with_symbols = []
+    try:
+        for elf_section in elf.sections:
+            # TODO: Maybe support multiple sections, not just .text, such as .data?
+            if elf_section.name == ".text":
+                assert code is None
+                # Copy the code out, since the ELF's memory map is closed before the file is overwritten.
+                code = bytearray(elf_section.data)
+            elif elf_section.type == ELFSectionType.SHT_RELA:
+                # Get the relocations.
+                assert elf_section.name.startswith(".rela")
+                relocated_section_name = elf_section.name[len(".rela") :]
+                assert relocated_section_name == ".text"
+
+                for elf_relocation in elf.relocations[elf_section.name]:
+                    elf_symbol = elf.symbols[".symtab"][elf_relocation.symbol_index]
+                    relocations_with_symbols.append((elf_relocation, elf_symbol))
+    finally:
+        # Always unmap the file, so it can still be deleted (on Windows) if this fails.
+        elf.close()
+
+    if not allow_undefined_symbols:
+        undefined_symbol_names = sorted(
+            set(
+                elf_symbol.name
+                for _, elf_symbol in relocations_with_symbols
+                if elf_symbol.section_index == ELFSymbolSpecialSection.SHN_UNDEF.value
+            )
+        )
+        if undefined_symbol_names:
+            raise UndefinedChunkSymbolsError(
+                "Undefined symbols: %s" % ", ".join(undefined_symbol_names)
+            )
+
+    if code is None:
+        assert not relocations_with_symbols
+        return []
+
+    relocations_in_elf = apply_local_relocations(
+        code, org_offset, relocations_with_symbols
+    )
+
+    # Overwrite the ELF file with just the raw, relocated binary code.
+    with open(bin_name, "wb") as f:
+        f.write(code)
+
+    return relocations_in_elf
+
+
+BRANCH_LABEL_RE = re.compile(r"^branch_label_([0-9A-F]+)$", re.IGNORECASE)
+# The instruction field mask, and the minimum and maximum relative offset, for each kind of branch relocation.
+LOCAL_BRANCH_RELOCATIONS = {
+    ELFRelocationType.R_PPC_REL24: (0x03FFFFFC, -0x2000000, 0x1FFFFFF, 24),
+    ELFRelocationType.R_PPC_REL14: (0x0000FFFC, -0x8000, 0x7FFF, 14),
+}
+# Below this many relocations, setting up the arrays costs more than it saves.
+VECTORIZED_RELOCATION_THRESHOLD = 64
+
+
+def get_relative_branch_error(relocation_type, branch_src_offset, branch_dest_offset):
+    bits = LOCAL_BRANCH_RELOCATIONS[relocation_type][3]
+    return Exception(
+        "Relocation failed: Cannot branch from %X to %X with a %d-bit relative offset."
+        % (branch_src_offset, branch_dest_offset, bits)
+    )
+
+
+def apply_local_relocations(code, org_offset, relocations_with_symbols):
+    # Patches every relocation that can be resolved now directly into code (a bytearray), and returns the rest for the game to apply at runtime.
+    if (
+        numpy is not None
+        and len(relocations_with_symbols) >= VECTORIZED_RELOCATION_THRESHOLD
+        and len(code) % 4 == 0
+        and all(
+            elf_relocation.relocation_offset % 4 == 0
+            for elf_relocation, _ in relocations_with_symbols
+        )
+    ):
+        return apply_local_relocations_vectorized(
+            code, org_offset, relocations_with_symbols
+        )
+
+    relocations_in_elf = []
+
+    for elf_relocation, elf_symbol in relocations_with_symbols:
+        is_local_relocation = try_apply_local_relocation(
+            code, org_offset, elf_relocation, elf_symbol
+        )
+
+        if not is_local_relocation:
+            relocations_in_elf.append(get_relocation_entry(elf_relocation, elf_symbol))
+
+    return relocations_in_elf
+
+
+def apply_local_relocations_vectorized(code, org_offset, relocations_with_symbols):
+    # Same as the loop in apply_local_relocations, but groups the relocations by type and patches each group at once through a big-endian u32 view of the code.
+    relocations_in_elf = []
+    branches_by_type = OrderedDict(
+        (relocation_type, ([], [], [])) for relocation_type in LOCAL_BRANCH_RELOCATIONS
+    )
+    addr32_offsets = []
+    addr32_addresses = []
+
+    for i, (elf_relocation, elf_symbol) in enumerate(relocations_with_symbols):
+        branch_label_match = BRANCH_LABEL_RE.search(elf_symbol.name)
+        if branch_label_match and elf_relocation.type in branches_by_type:
+            indices, offsets, dest_offsets = branches_by_type[elf_relocation.type]
+            indices.append(i)
+            offsets.append(elf_relocation.relocation_offset)
+            dest_offsets.append(int(branch_label_match.group(1), 16))
+        elif elf_relocation.type == ELFRelocationType.R_PPC_ADDR32:
+            addr32_offsets.append(elf_relocation.relocation_offset)
+            addr32_addresses.append(elf_symbol.address)
+        else:
+            relocations_in_elf.append(get_relocation_entry(elf_relocation, elf_symbol))
+
+    words = numpy.frombuffer(code, dtype=">u4")
+
+    # Check every branch before patching any, and report the first out of range one in file order, like the one at a time path does.
+    branch_patches = []
+    first_error = None
+    for relocation_type, (indices, offsets, dest_offsets) in branches_by_type.items():
+        if not indices:
+            continue
+        field_mask, min_offset, max_offset, _ = LOCAL_BRANCH_RELOCATIONS[
+            relocation_type
+        ]
+        offsets = numpy.array(offsets, dtype=numpy.int64)
+        dest_offsets = numpy.array(dest_offsets, dtype=numpy.int64)
+        branch_src_offsets = org_offset + offsets
+        relative_branch_offsets = ((dest_offsets - branch_src_offsets) // 4) << 2
+
+        out_of_range = numpy.flatnonzero(
+            (relative_branch_offsets > max_offset)
+            | (relative_branch_offsets < min_offset)
+        )
+        if len(out_of_range) > 0:
+            error_index = out_of_range[0]
+            if first_error is None or indices[error_index] < first_error[0]:
+                first_error = (
+                    indices[error_index],
+                    relocation_type,
+                    int(branch_src_offsets[error_index]),
+                    int(dest_offsets[error_index]),
+                )
+            continue
+
+        branch_patches.append(
+            (offsets // 4, field_mask, relative_branch_offsets & field_mask)
+        )
+
+    if first_error is not None:
+        raise get_relative_branch_error(*first_error[1:])
+
+    for word_indices, field_mask, fields in branch_patches:
+        words[word_indices] = (
+            words[word_indices] & (~field_mask & 0xFFFFFFFF)
+        ) | fields
+
+    if addr32_offsets:
+        words[numpy.array(addr32_offsets, dtype=numpy.int64) // 4] = addr32_addresses
+
+    return relocations_in_elf
+
+
+def get_relocation_entry(elf_relocation, elf_symbol):
+    return OrderedDict(
+        [
+            ["SymbolName", elf_symbol.name],
+            ["Offset", elf_relocation.relocation_offset],
+            ["Type", elf_relocation.type.name],
+        ]
+    )
+
+
+def try_apply_local_relocation(code, org_offset, elf_relocation, elf_symbol):
+    branch_label_match = BRANCH_LABEL_RE.search(elf_symbol.name)
+    if branch_label_match and elf_relocation.type in LOCAL_BRANCH_RELOCATIONS:
+        # We should relocate the relative branches within this REL ourselves so the game doesn't need to do it at runtime.
+        branch_src_offset = org_offset + elf_relocation.relocation_offset
+        branch_dest_offset = int(branch_label_match.group(1), 16)
+        relative_branch_offset = ((branch_dest_offset - branch_src_offset) // 4) << 2
+
+        field_mask, min_offset, max_offset, _ = LOCAL_BRANCH_RELOCATIONS[
+            elf_relocation.type
+        ]
+        if relative_branch_offset > max_offset or relative_branch_offset < min_offset:
+            raise get_relative_branch_error(
+                elf_relocation.type, branch_src_offset, branch_dest_offset
+            )
+
+        instruction = unpack_u32_from(code, elf_relocation.relocation_offset)
+        instruction &= ~field_mask
+        instruction |= relative_branch_offset & field_mask
+        pack_u32_into(code, elf_relocation.relocation_offset, instruction)
+
+        return True
+
+    if elf_relocation.type == ELFRelocationType.R_PPC_ADDR32:
+        # Also relocate absolute pointers into main.dol.
+        pack_u32_into(code, elf_relocation.relocation_offset, elf_symbol.address)
+
+        return True
+
+    return False
+
+
+def is_free_space_org(org_offset_or_symbol):
+    if isinstance(org_offset_or_symbol, int):
+        return False
+    return re.search(r"@FreeSpace_\d+", org_offset_or_symbol) is not None
+
+
+def get_free_space_section_name(chunk_index):
+    return ".text.free_space_%d" % chunk_index
+
+
+def check_duplicate_org(used_org_offsets, org_offset):
+    if org_offset in used_org_offsets:
+        raise Exception(
+            "Duplicate .org directive within a single asm patch: %X." % org_offset
+        )
+    used_org_offsets.add(org_offset)
+
+
+# Symbols are defined by labels, by .set and its aliases, or by assignment.
+CHUNK_SYMBOL_DEFINITION_RE = re.compile(
+    r"^\s*(?:"
+    r"([a-zA-Z_.][a-zA-Z0-9_.]*):"
+    r"|\.(?:set|equ|equiv|eqv)\s+([a-zA-Z_.][a-zA-Z0-9_.]*)\s*,"
+    r"|([a-zA-Z_.][a-zA-Z0-9_.]*)\s*=(?!=)"
+    r")",
+    re.MULTILINE,
+)
+CHUNK_SYMBOL_RE = re.compile(r"[a-zA-Z_.][a-zA-Z0-9_.]*")
+
+
+def schedule_chunk_waves(chunks):
+    # Groups the (org, asm) chunks into waves, where every chunk in a wave only depends on chunks in earlier waves.
+    # A chunk depends on an earlier chunk if it references one of the symbols the earlier chunk defines.
+    # Symbols defined in ways this can't see are caught after linking (see UndefinedChunkSymbolsError).
+    defined_labels = []
+    chunk_levels = []
+    for org_offset_or_symbol, temp_asm in chunks:
+        referenced_symbols = set(CHUNK_SYMBOL_RE.findall(temp_asm))
+        if not isinstance(org_offset_or_symbol, int):
+            referenced_symbols.add(org_offset_or_symbol)
+
+        level = 0
+        for other_labels, other_level in zip(defined_labels, chunk_levels):
+            if not other_labels.isdisjoint(referenced_symbols):
+                level = max(level, other_level + 1)
+
+        defined_labels.append(
+            set(
+                symbol_name
+                for definition in CHUNK_SYMBOL_DEFINITION_RE.findall(temp_asm)
+                for symbol_name in definition
+                if symbol_name
+            )
+        )
+        chunk_levels.append(level)
+
+    waves = [[] for _ in range(max(chunk_levels, default=-1) + 1)]
+    for chunk_index, level in enumerate(chunk_levels):
+        waves[level].append(chunk_index)
+    return waves
+
+
+SDA_RE = re.compile(r"([a-z]+) (r[0-9]+), *([a-zA-Z0-9_]+)@sda21 *\(r13\).*")
+
+
+class PatchAssembler:
+    # Assembles the asm patches for a single game version.
+    # Everything version specific lives here, so several versions can be assembled at the same time.
+
+    def __init__(
+        self, version, linker_script, asm_macros, temp_dir, batch_free_space=False
+    ):
+        self.version = version
+        self.config = VERSION_CONFIGS[version]
+        self.asm_macros = asm_macros
+        self.temp_dir = temp_dir
+        # Whether to link all of a file's free space chunks in a patch together, instead of one at a time.
+        self.batch_free_space = batch_free_space
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+        self.sda_13_base = self.config["sda_13_base"]
+        self.sda_13_max = self.sda_13_base + 0x7FFF
+        self.sda_13_min = self.sda_13_base - 0x8000
+
+        self.original_symbols = load_symbol_table(f"original_symbols/{version}.txt")
+
+        with open(f"free_space_start_offsets/{version}.txt", "r") as f:
+            self.free_space_start_offsets = yaml.safe_load(f)
+
+        # add main dol symbols
+        # This block is shared by every link for this version, so it's only written once.
+        self.base_linker_script = LinkerScriptBuilder(self.temp_dir)
+        self.base_linker_script.add_segment(
+            linker_script + self.original_symbols.get_linker_script("main.dol") + "\n"
+        )
+
+    def handle_sda_instr(self, line: str) -> str:
+        with profiler.stage("sda_rewrite", self.version):
+            return self.rewrite_sda_instr(line)
+
+    def rewrite_sda_instr(self, line: str) -> str:
+        match = SDA_RE.match(line)
+        if not match:
+            raise Exception(line)
+        instr = match.group(1)
+        reg = match.group(2)
+        lbl = match.group(3)
+        address = self.original_symbols.get_address("main.dol", lbl)
+        if address < self.sda_13_min or address > self.sda_13_max:
+            raise Exception(f"Relocation failed, SDA for symbol {lbl} out of range.")
+        if instr == "la":
+            return f"addi {reg}, r13, {address-self.sda_13_base}"
+        else:
+            return f"{instr} {reg}, {address-self.sda_13_base}(r13)"
+
+    def get_patch_paths(self):
+        return glob.glob(f"./patches/{self.version}/*.asm")
+
+    def get_diff_path(self, patch_name):
+        return os.path.join(".", "patch_diffs", self.version, patch_name + "_diff.txt")
+
+    def get_custom_symbols_path(self):
+        return f"./custom_symbols/{self.version}.txt"
+
+    def get_custom_rel_path(self):
+        return f"../custom-rel/{self.config['custom_rel_dir']}/customNP.rel"
+
+    def get_patch_output_inputs(self):
+        # Returns the inputs of every file written by assemble_patches.
+        # Each patch continues from the custom symbols and free space left by the patches before it, so its diff depends on all of them.
+        patch_inputs = hash_input_files(
+            "asm_macros.asm",
+            "linker.ld",
+            "version_config.yaml",
+            f"original_symbols/{self.version}.txt",
+            f"free_space_start_offsets/{self.version}.txt",
+            *PATCH_OUTPUT_GENERATORS,
+        )
+        patch_inputs["rust:static"] = fingerprint_rust_crate(
+            rust_builder.crate_dir, "static"
+        )
+        patch_inputs["toolchain"] = toolchain_version
+        # Batching free space chunks lays the code out differently.
+        patch_inputs["batch_free_space"] = str(self.batch_free_space)
+
+        output_inputs = OrderedDict()
+        for patch_path in self.get_patch_paths():
+            patch_inputs.update(hash_input_files(patch_path))
+            patch_name = os.path.splitext(os.path.basename(patch_path))[0]
+            output_inputs[self.get_diff_path(patch_name)] = dict(patch_inputs)
+        output_inputs[self.get_custom_symbols_path()] = dict(patch_inputs)
+        return output_inputs
+
+    def get_custom_rel_inputs(self, feature):
+        rel_inputs = hash_input_files(
+            "merge.ld",
+            f"original_symbols/{self.version}.txt",
+            self.get_custom_symbols_path(),
+            *CUSTOM_REL_GENERATORS,
+        )
+        rel_inputs["rust:" + feature] = fingerprint_rust_crate(
+            rust_builder.crate_dir, feature
+        )
+        rel_inputs["toolchain"] = toolchain_version
+        return rel_inputs
+
+    def parse_patches(self):
+        # Parse all the asm files into code chunks.
+        self.patch_chunks = PatchChunks(
+            self.config["main_injection"],
+            self.free_space_start_offsets,
+            self.handle_sda_instr,
+        )
+        for patch_path in self.get_patch_paths():
+            print("Assembling %s/%s" % (self.version, os.path.basename(patch_path)))
+            with profiler.stage(
+                "parse", "%s/%s" % (self.version, os.path.basename(patch_path))
+            ):
+                self.patch_chunks.add_patch(patch_path)
+        self.code_chunks = self.patch_chunks.code_chunks
+
+    def assemble_chunk(
+        self,
+        patch_name,
+        file_path,
+        org_offset,
+        temp_asm,
+        temp_linker_name,
+        temp_linker_hash,
+        is_custom_function,
+        rust_static_lib=None,
+        allow_undefined_symbols=True,
+    ):
+        # Assembles and links a single code chunk, returning its code, the symbols it defines and its relocations.
+        # Every temporary file is unique to the chunk, so independent chunks can be built at the same time.
+        # Without allow_undefined_symbols, a REL chunk whose relocations refer to undefined symbols raises UndefinedChunkSymbolsError.
+        links_rust_functions = rust_static_lib is not None
+        cache_key = hash_inputs(
+            CHUNK_CACHE_FORMAT,
+            temp_asm,
+            self.asm_macros,
+            temp_linker_hash,
+            org_offset,
+            file_path.endswith(".rel"),
+            is_custom_function,
+            toolchain_version,
+            hash_file(rust_static_lib) if links_rust_functions else "",
+        )
+        cached_result = chunk_cache.get(cache_key)
+        if cached_result is not None:
+            print(
+                "Using cached chunk %s %s at 0x%08X"
+                % (self.version, file_path, org_offset)
+            )
+            print()
+            return cached_result
+
+        chunk_name = "tmp_" + patch_name + "_%08X" % org_offset
+        chunk_label = "%s/%s" % (self.version, chunk_name)
+
+        temp_asm_name = os.path.join(self.build_dir, chunk_name + ".asm")
+        with open(temp_asm_name, "w") as f:
+            f.write(
+                self.asm_macros
+            )  # Add our custom asm macros to all asm at the start.
+            f.write("\n")
+            f.write(temp_asm)
+
+        o_name = os.path.join(self.build_dir, chunk_name + ".o")
+        command = [
+            get_bin("powerpc-eabi-as"),
+            "-mregnames",
+            "-m750cl",
+            temp_asm_name,
+            "-o",
+            o_name,
+        ]
+        print(" ".join(command))
+        print()
+        result = profiler.call("as", chunk_label, command)
+        if result != 0:
+            raise Exception("Assembler call failed.")
+
+        bin_name = os.path.join(self.build_dir, chunk_name + ".bin")
+        map_name = os.path.join(self.build_dir, chunk_name + ".map")
+        relocations = []
+        command = [
+            get_bin("powerpc-eabi-ld"),
+            "-Ttext",
+            "%X" % org_offset,
+            "-T",
+            temp_linker_name,
+            "-Map=" + map_name,
+            o_name,
+            "-o",
+            bin_name,
+        ]
+
+        # add custom functions from rust
+        if links_rust_functions:
+            command.extend(
+                (
+                    "-(",
+                    rust_static_lib,
+                    "--gc-sections",
+                    "--print-gc-sections",
+                    "-)",
+                )
+            )
+
+        if file_path.endswith(".rel"):
+            # Output an ELF with relocations for RELs.
+            command += ["--relocatable"]
+        else:
+            # normally, just output the raw binary code, not an ELF.
+            # for the main custom function output an elf first so that the linker pruning works
+            if not is_custom_function:
+                command += ["--oformat", "binary"]
+            pass
+        print(" ".join(command))
+        print()
+        result = profiler.call("ld", chunk_label, command)
+        if result != 0:
+            raise Exception("Linker call failed.")
+        # Keep track of custom symbols so they can be passed in the linker script to future assembler calls.
+        with profiler.stage("map_parse", chunk_label):
+            symbols = read_link_map(map_name).symbols
+
+        if file_path.endswith(".rel"):
+            # This is for a REL, so we can't link it.
+            # Instead read the ELF to get the assembled code and relocations out of it directly.
+            with profiler.stage("elf_relocation", chunk_label):
+                relocations += get_code_and_relocations_from_elf(
+                    bin_name, org_offset, allow_undefined_symbols
+                )
+
+        if links_rust_functions:
+            objcopied_name = os.path.join(self.build_dir, chunk_name + "_copy.bin")
+            command = [
+                get_bin("powerpc-eabi-objcopy"),
+                "-O",
+                "binary",
+                bin_name,
+                objcopied_name,
+            ]
+            print(" ".join(command))
+            print()
+            result = profiler.call("objcopy", chunk_label, command)
+            if result != 0:
+                raise Exception("Objcopy call failed.")
+            with open(objcopied_name, "rb") as f:
+                binary_data = f.read()
+        else:
+            with open(bin_name, "rb") as f:
+                binary_data = f.read()
+
+        chunk_result = (binary_data, symbols, relocations)
+        chunk_cache.put(cache_key, chunk_result)
+        return chunk_result
+
+    def assemble_free_space_chunks(
+        self,
+        patch_name,
+        file_path,
+        org_offset,
+        temp_asms,
+        temp_linker_name,
+        temp_linker_hash,
+        rust_static_lib=None,
+    ):
+        # Assembles and links all of a file's free space chunks at once, returning one (code, symbols, relocations) result per chunk.
+        # Each chunk goes in its own section. The linker script places them one after another, and the map file says where each one ended up.
+        links_rust_functions = rust_static_lib is not None
+        cache_key = hash_inputs(
+            CHUNK_CACHE_FORMAT,
+            "free_space_batch",
+            len(temp_asms),
+            *temp_asms,
+            self.asm_macros,
+            temp_linker_hash,
+            org_offset,
+            toolchain_version,
+            hash_file(rust_static_lib) if links_rust_functions else "",
+        )
+        cached_result = chunk_cache.get(cache_key)
+        if cached_result is not None:
+            print(
+                "Using cached free space chunks %s %s at 0x%08X"
+                % (self.version, file_path, org_offset)
+            )
+            print()
+            return cached_result
+
+        chunk_name = "tmp_" + patch_name + "_free_space"
+        chunk_label = "%s/%s" % (self.version, chunk_name)
+
+        temp_asm_name = os.path.join(self.build_dir, chunk_name + ".asm")
+        with open(temp_asm_name, "w") as f:
+            f.write(self.asm_macros)
+            f.write("\n")
+            for chunk_index, temp_asm in enumerate(temp_asms):
+                f.write(
+                    '.section %s, "ax"\n' % get_free_space_section_name(chunk_index)
+                )
+                f.write(temp_asm)
+
+        o_name = os.path.join(self.build_dir, chunk_name + ".o")
+        command = [
+            get_bin("powerpc-eabi-as"),
+            "-mregnames",
+            "-m750cl",
+            temp_asm_name,
+            "-o",
+            o_name,
+        ]
+        print(" ".join(command))
+        print()
+        result = profiler.call("as", chunk_label, command)
+        if result != 0:
+            raise Exception("Assembler call failed.")
+
+        elf_name = os.path.join(self.build_dir, chunk_name + ".elf")
+        map_name = os.path.join(self.build_dir, chunk_name + ".map")
+        command = [
+            get_bin("powerpc-eabi-ld"),
+            "-Ttext",
+            "%X" % org_offset,
+            "-T",
+            temp_linker_name,
+            "-Map=" + map_name,
+            o_name,
+            "-o",
+            elf_name,
+        ]
+        if links_rust_functions:
+            command.extend(
+                (
+                    "-(",
+                    rust_static_lib,
+                    "--gc-sections",
+                    "--print-gc-sections",
+                    "-)",
+                )
+            )
+        print(" ".join(command))
+        print()
+        result = profiler.call("ld", chunk_label, command)
+        if result != 0:
+            raise Exception("Linker call failed.")
+
+        bin_name = os.path.join(self.build_dir, chunk_name + ".bin")
+        command = [
+            get_bin("powerpc-eabi-objcopy"),
+            "-O",
+            "binary",
+            elf_name,
+            bin_name,
+        ]
+        print(" ".join(command))
+        print()
+        result = profiler.call("objcopy", chunk_label, command)
+        if result != 0:
+            raise Exception("Objcopy call failed.")
+        with open(bin_name, "rb") as f:
+            binary_data = f.read()
+
+        with profiler.stage("map_parse", chunk_label):
+            link_map = read_link_map(map_name)
+        symbols = link_map.symbols
+        chunk_starts = []
+        for chunk_index in range(len(temp_asms)):
+            section_addresses = link_map.get_input_section_addresses(
+                get_free_space_section_name(chunk_index)
+            )
+            if not section_addresses:
+                raise Exception(
+                    "Free space chunk %d of %s is missing from the map file."
+                    % (chunk_index, file_path)
+                )
+            chunk_starts.append(section_addresses[0])
+        # Anything placed before the first chunk's section belongs to it.
+        chunk_starts[0] = org_offset
+
+        # Each chunk runs up to the start of the next one. Anything linked in after the last chunk, like Rust functions, belongs to the last one.
+        chunk_results = []
+        for chunk_index, chunk_start in enumerate(chunk_starts):
+            if chunk_index + 1 < len(chunk_starts):
+                chunk_end = chunk_starts[chunk_index + 1]
+            else:
+                chunk_end = org_offset + len(binary_data)
+            chunk_symbols = OrderedDict()
+            for symbol_name, symbol_address in symbols.items():
+                if chunk_start <= symbol_address < chunk_end or (
+                    chunk_index + 1 == len(chunk_starts)
+                    and not (chunk_starts[0] <= symbol_address < chunk_start)
+                ):
+                    chunk_symbols[symbol_name] = symbol_address
+            chunk_results.append(
+                (
+                    binary_data[chunk_start - org_offset : chunk_end - org_offset],
+                    chunk_symbols,
+                    [],
+                )
+            )
+
+        chunk_cache.put(cache_key, chunk_results)
+        return chunk_results
+
+    def assemble_free_space_chunk_batch(
+        self,
+        patch_name,
+        file_path,
+        free_space_chunks,
+        temp_linker_script,
+        diffs_for_file,
+        custom_symbols_for_file,
+        used_org_offsets,
+    ):
+        # The Rust functions are only linked once, after all of the chunks, instead of into whichever chunk first calls them.
+        rust_static_lib = None
+        if file_path == "main.dol":
+            rust_static_lib = rust_builder.build("static", format_sources=True)
+
+        org_offset = self.next_free_space_offsets[file_path]
+        chunk_results = self.assemble_free_space_chunks(
+            patch_name,
+            file_path,
+            org_offset,
+            free_space_chunks,
+            temp_linker_script.write("tmp_%s_free_space" % patch_name),
+            temp_linker_script.get_content_hash(),
+            rust_static_lib,
+        )
+        for chunk_result in chunk_results:
+            org_offset = self.next_free_space_offsets[file_path]
+            check_duplicate_org(used_org_offsets, org_offset)
+            self.add_chunk_result(
+                diffs_for_file,
+                custom_symbols_for_file,
+                file_path,
+                org_offset,
+                *chunk_result,
+            )
+            temp_linker_script.add_symbols(chunk_result[1])
+
+    def link_chunk_waves(
+        self,
+        pool,
+        patch_name,
+        file_path,
+        chunks,
+        waves,
+        temp_linker_script,
+        custom_symbols_for_file,
+        used_org_offsets,
+        allow_undefined_symbols,
+    ):
+        # Links the (org, asm) chunks wave by wave, adding each wave's symbols to temp_linker_script for the waves after it.
+        # Returns chunk index -> (org offset, chunk result).
+        chunk_results = {}
+        linked_symbols = OrderedDict()
+        for wave_index, wave in enumerate(waves):
+            # All chunks in a wave link against the same script.
+            wave_linker_name = temp_linker_script.write(
+                "tmp_%s_wave_%d" % (patch_name, wave_index)
+            )
+            wave_linker_hash = temp_linker_script.get_content_hash()
+            wave_futures = []
+            for chunk_index in wave:
+                org_offset_or_symbol, temp_asm = chunks[chunk_index]
+                if isinstance(org_offset_or_symbol, int):
+                    org_offset = org_offset_or_symbol
+                else:
+                    org_symbol = org_offset_or_symbol
+                    if org_symbol in custom_symbols_for_file:
+                        org_offset = custom_symbols_for_file[org_symbol]
+                    elif org_symbol in linked_symbols:
+                        org_offset = linked_symbols[org_symbol]
+                    else:
+                        raise Exception(
+                            ".org specified an invalid custom symbol: %s." % org_symbol
+                        )
+                check_duplicate_org(used_org_offsets, org_offset)
+
+                future = pool.submit(
+                    self.assemble_chunk,
+                    patch_name,
+                    file_path,
+                    org_offset,
+                    temp_asm,
+                    wave_linker_name,
+                    wave_linker_hash,
+                    False,
+                    allow_undefined_symbols=allow_undefined_symbols,
+                )
+                wave_futures.append((org_offset, future))
+
+            # Let the whole wave finish before any error is raised, since linking again reuses the same temporary files.
+            wait([future for _, future in wave_futures])
+            # Merge in a fixed order so the output doesn't depend on which link finished first.
+            for chunk_index, (org_offset, future) in zip(wave, wave_futures):
+                chunk_result = future.result()
+                chunk_results[chunk_index] = (org_offset, chunk_result)
+                linked_symbols.update(chunk_result[1])
+                temp_linker_script.add_symbols(chunk_result[1])
+        return chunk_results
+
+    def add_chunk_result(
+        self,
+        diffs_for_file,
+        custom_symbols_for_file,
+        file_path,
+        org_offset,
+        binary_data,
+        symbols,
+        relocations,
+    ):
+        custom_symbols_for_file.update(symbols)
+
+        # Keep track of changed bytes.
+        code_chunk_size_in_bytes = len(binary_data)
+        self.next_free_space_offsets[file_path] += code_chunk_size_in_bytes
+
+        diffs_for_file[org_offset] = OrderedDict()
+        diffs_for_file[org_offset]["Data"] = binary_data
+        if relocations:
+            diffs_for_file[org_offset]["Relocations"] = relocations
+
+    def assemble_patches(self, pool):
+        # Every file made while assembling goes in a directory of its own, which is removed afterwards.
+        # Otherwise each rebuild in watch mode would leave another set of chunks and linker script segments in temp_dir.
+        self.build_dir = tempfile.mkdtemp(prefix="build_", dir=self.temp_dir)
+        try:
+            self.assemble_patches_in_build_dir(pool)
+        finally:
+            shutil.rmtree(self.build_dir)
+
+    def assemble_patches_in_build_dir(self, pool):
+        # Start from a clean slate, since the same assembler is reused for every rebuild in watch mode.
+        self.custom_symbols = OrderedDict()
+        self.custom_symbols["main.dol"] = OrderedDict()
+
+        self.next_free_space_offsets = {}
+        for file_path, offset in self.free_space_start_offsets.items():
+            self.next_free_space_offsets[file_path] = offset
+
+        self.parse_patches()
+
+        for patch_name, code_chunks_for_patch in self.code_chunks.items():
+            diffs = OrderedDict()
+
+            for file_path, code_chunks_for_file in code_chunks_for_patch.items():
+                if file_path not in self.custom_symbols:
+                    self.custom_symbols[file_path] = OrderedDict()
+                custom_symbols_for_file = self.custom_symbols[file_path]
+                diffs[file_path] = OrderedDict()
+                used_org_offsets = set()
+
+                temp_linker_script = self.base_linker_script.copy(self.build_dir)
+                # Add custom symbols in the current file to the temporary linker script.
+                file_linker_script = get_symbols_linker_script(custom_symbols_for_file)
+                # And add any local branches inside this file.
+                file_linker_script += (
+                    self.patch_chunks.get_local_branches_linker_script(file_path)
+                )
+                if file_path != "main.dol":
+                    # Also add custom symbols in main.dol for all files.
+                    file_linker_script += get_symbols_linker_script(
+                        self.custom_symbols["main.dol"]
+                    )
+                temp_linker_script.add_segment(file_linker_script)
+
+                # Free space chunks have to be assembled one after another, since each one starts where the previous one ended.
+                # They come first so that the other chunks can branch to them.
+                free_space_chunks = []
+                other_chunks = []
+                for org_offset_or_symbol, temp_asm in code_chunks_for_file.items():
+                    if is_free_space_org(org_offset_or_symbol):
+                        free_space_chunks.append(temp_asm)
+                    else:
+                        other_chunks.append((org_offset_or_symbol, temp_asm))
+
+                if (
+                    self.batch_free_space
+                    and free_space_chunks
+                    and not file_path.endswith(".rel")
+                ):
+                    self.assemble_free_space_chunk_batch(
+                        patch_name,
+                        file_path,
+                        free_space_chunks,
+                        temp_linker_script,
+                        diffs[file_path],
+                        custom_symbols_for_file,
+                        used_org_offsets,
+                    )
+                    free_space_chunks = []
+
+                for temp_asm in free_space_chunks:
+                    org_offset = self.next_free_space_offsets[file_path]
+                    check_duplicate_org(used_org_offsets, org_offset)
+
+                    # add custom functions from rust
+                    rust_static_lib = None
+                    if file_path == "main.dol":
+                        rust_static_lib = rust_builder.build(
+                            "static", format_sources=True
+                        )
+
+                    chunk_result = self.assemble_chunk(
+                        patch_name,
+                        file_path,
+                        org_offset,
+                        temp_asm,
+                        temp_linker_script.write(
+                            "tmp_%s_%08X" % (patch_name, org_offset)
+                        ),
+                        temp_linker_script.get_content_hash(),
+                        True,
+                        rust_static_lib,
+                    )
+                    self.add_chunk_result(
+                        diffs[file_path],
+                        custom_symbols_for_file,
+                        file_path,
+                        org_offset,
+                        *chunk_result,
+                    )
+                    temp_linker_script.add_symbols(chunk_result[1])
+
+                # Every other chunk only depends on the free space chunks, unless it references a symbol defined in another chunk.
+                # Chunks with no dependencies between them are assembled and linked at the same time.
+                waves = schedule_chunk_waves(other_chunks)
+                sequential_linker_script = temp_linker_script.copy()
+                sequential_org_offsets = set(used_org_offsets)
+                try:
+                    chunk_results = self.link_chunk_waves(
+                        pool,
+                        patch_name,
+                        file_path,
+                        other_chunks,
+                        waves,
+                        temp_linker_script,
+                        custom_symbols_for_file,
+                        used_org_offsets,
+                        # Only a wave with several chunks in it can miss a symbol from one of the others.
+                        all(len(wave) == 1 for wave in waves),
+                    )
+                except UndefinedChunkSymbolsError as e:
+                    # A chunk used a symbol defined in a way schedule_chunk_waves couldn't see, so link every chunk in order instead.
+                    print(
+                        "%s. Linking the chunks for %s %s one at a time."
+                        % (e, self.version, file_path)
+                    )
+                    print()
+                    used_org_offsets = sequential_org_offsets
+                    chunk_results = self.link_chunk_waves(
+                        pool,
+                        patch_name,
+                        file_path,
+                        other_chunks,
+                        [[chunk_index] for chunk_index in range(len(other_chunks))],
+                        sequential_linker_script,
+                        custom_symbols_for_file,
+                        used_org_offsets,
+                        True,
+                    )
+
+                for chunk_index in range(len(other_chunks)):
+                    org_offset, chunk_result = chunk_results[chunk_index]
+                    self.add_chunk_result(
+                        diffs[file_path],
+                        custom_symbols_for_file,
+                        file_path,
+                        org_offset,
+                        *chunk_result,
+                    )
+
+            with profiler.stage("yaml_dump", self.get_diff_path(patch_name)):
+                write_patch_diff(self.get_diff_path(patch_name), diffs)
+
+        self.write_custom_symbols()
+
+    def write_custom_symbols(self):
+        # Write the custom symbols to a text file.
+        # Delete any entries in custom_symbols that have no custom symbols to avoid clutter.
+        output_custom_symbols = OrderedDict()
+        for file_path, custom_symbols_for_file in self.custom_symbols.items():
+            if file_path != "main.dol" and len(custom_symbols_for_file) == 0:
+                continue
+
+            output_custom_symbols[file_path] = custom_symbols_for_file
+
+        with open(self.get_custom_symbols_path(), "w") as f, profiler.stage(
+            "yaml_dump", self.get_custom_symbols_path()
+        ):
+            f.write(
+                yaml.dump(
+                    output_custom_symbols,
+                    Dumper=yaml.CDumper,
+                    default_flow_style=False,
+                    line_break="\n",
+                )
+            )
+
+    def build_custom_rel(self, merged_elf):
+        with profiler.stage("create_lst", self.version):
+            lst_symbols = get_lst_symbols(self.version)
+        with profiler.stage("elf_to_rel", self.version):
+            dat = build_rel(1000, merged_elf, lst_symbols)
+
+        with open(self.get_custom_rel_path(), "wb") as f:
+            f.write(dat)
+
+
+def build_custom_functions_elf(temp_dir, feature):
+    # The dynamic rust code is the same for every version, so it only needs to be built and merged once.
+    # Build dynamic rust code (for a custom rel)
+    outpath = os.path.abspath(rust_builder.build(feature))
+    # Unchanged rust code reuses the merged ELF from a previous build.
+    return rel_builder.get_merged_archive(outpath, temp_dir, feature)
+
+
+def load_assemblers(versions, temp_dir, batch_free_space=False):
+    with open("linker.ld") as f:
+        linker_script = f.read()
+
+    with open("asm_macros.asm") as f:
+        asm_macros = f.read()
+
+    return [
+        PatchAssembler(
+            version,
+            linker_script,
+            asm_macros,
+            os.path.join(temp_dir, version),
+            batch_free_space,
+        )
+        for version in versions
+    ]
+
+
+def build(assemblers, pool, dependency_graph, temp_dir, feature, incremental):
+    profiler.reset()
+    build_patches_and_rels(
+        assemblers, pool, dependency_graph, temp_dir, feature, incremental
+    )
+    for cache in (chunk_cache, symbol_cache, rust_builder.cache, rel_builder.cache):
+        cache.prune()
+    profiler.write_report()
+
+
+def build_patches_and_rels(
+    assemblers, pool, dependency_graph, temp_dir, feature, incremental
+):
+    # The patches for a version are always regenerated together, since each patch builds on the ones before it.
+    # Unchanged chunks still come from the chunk cache.
+    patch_output_inputs = {}
+    stale_assemblers = []
+    for assembler in assemblers:
+        patch_output_inputs[assembler] = assembler.get_patch_output_inputs()
+        if incremental and not dependency_graph.get_stale_outputs(
+            patch_output_inputs[assembler]
+        ):
+            print("Patches for %s are up to date." % assembler.version)
+            print()
+            continue
+        stale_assemblers.append(assembler)
+
+    if stale_assemblers:
+        # Every version is assembled on its own thread, and they all share one pool for linking chunks.
+        with ThreadPoolExecutor(max_workers=len(stale_assemblers)) as version_pool:
+            for _ in version_pool.map(
+                lambda assembler: assembler.assemble_patches(pool),
+                stale_assemblers,
+            ):
+                pass
+
+        for assembler in stale_assemblers:
+            for output_path, inputs in patch_output_inputs[assembler].items():
+                dependency_graph.record(output_path, inputs)
+        dependency_graph.save()
+
+    rel_inputs = {}
+    stale_rel_assemblers = []
+    for assembler in assemblers:
+        rel_inputs[assembler] = assembler.get_custom_rel_inputs(feature)
+        if incremental and not dependency_graph.is_stale(
+            assembler.get_custom_rel_path(), rel_inputs[assembler]
+        ):
+            print("Custom REL for %s is up to date." % assembler.version)
+            print()
+            continue
+        stale_rel_assemblers.append(assembler)
+
+    if stale_rel_assemblers:
+        merged_elf = build_custom_functions_elf(temp_dir, feature)
+        for assembler in stale_rel_assemblers:
+            assembler.build_custom_rel(merged_elf)
+            dependency_graph.record(
+                assembler.get_custom_rel_path(), rel_inputs[assembler]
+            )
+        dependency_graph.save()
+
+
+WATCH_POLL_INTERVAL = 0.5
+WATCHED_DIRS = ["./patches", "./custom-functions/src"]
+# Changes to these are picked up by reloading the assemblers, since their parsed contents are kept in memory.
+WATCHED_CONFIG_FILES = [
+    "asm_macros.asm",
+    "linker.ld",
+    "merge.ld",
+    "version_config.yaml",
+    *glob.glob("./original_symbols/*.txt"),
+    *glob.glob("./free_space_start_offsets/*.txt"),
+]
+
+
+def get_file_mtimes(file_paths):
+    file_mtimes = {}
+    for file_path in file_paths:
+        try:
+            file_mtimes[file_path] = os.stat(file_path).st_mtime_ns
+        except OSError:
+            pass
+    return file_mtimes
+
+
+def get_watched_file_mtimes():
+    file_paths = []
+    for watched_dir in WATCHED_DIRS:
+        for dir_path, _, file_names in os.walk(watched_dir):
+            file_paths += [os.path.join(dir_path, name) for name in file_names]
+    return get_file_mtimes(file_paths)
+
+
+def watch(versions, pool, dependency_graph, temp_dir, feature, batch_free_space):
+    # Keeps the parsed symbol tables, linker scripts and caches in memory, and rebuilds whatever a change makes out of date.
+    assemblers = load_assemblers(versions, temp_dir, batch_free_space)
+    config_mtimes = get_file_mtimes(WATCHED_CONFIG_FILES)
+    watched_mtimes = None
+    while True:
+        new_config_mtimes = get_file_mtimes(WATCHED_CONFIG_FILES)
+        new_watched_mtimes = get_watched_file_mtimes()
+        if new_config_mtimes != config_mtimes or new_watched_mtimes != watched_mtimes:
+            try:
+                if new_config_mtimes != config_mtimes:
+                    assemblers = load_assemblers(versions, temp_dir, batch_free_space)
+                build(assemblers, pool, dependency_graph, temp_dir, feature, True)
+            except Exception as e:
+                stack_trace = traceback.format_exc()
+                print(str(e) + "\n\n" + stack_trace)
+            # Take the mtimes after the build, since cargo fmt may have rewritten some of the Rust sources during it.
+            config_mtimes = get_file_mtimes(WATCHED_CONFIG_FILES)
+            watched_mtimes = get_watched_file_mtimes()
+            print("Watching for changes...")
+            print()
+        time.sleep(WATCH_POLL_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Assembles the asm patches and the custom REL for each game version."
+    )
+    parser.add_argument(
+        "versions",
+        nargs="*",
+        help="Game versions to build (%s). Builds all of them by default."
+        % ", ".join(VERSION_CONFIGS),
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Build the custom REL with extra debug features.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only regenerate the outputs whose inputs changed since the last build.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and rebuild whenever a patch or Rust source file changes.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Time every stage of the build and write a report (see --profile-output).",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default="build_profile",
+        metavar="NAME",
+        help="Write the --profile report to NAME.json and NAME.html (build_profile by default).",
+    )
+    parser.add_argument(
+        "--batch-free-space",
+        action="store_true",
+        help="Assemble and link all of a patch's free space chunks for a file in one go. Rust functions are then placed after all of the chunks, so the output differs from a normal build.",
+    )
+    args = parser.parse_args()
+
+    # Each version can only be built once at a time, since its assembler owns that version's temp directory and outputs.
+    versions = list(OrderedDict.fromkeys(args.versions)) or list(VERSION_CONFIGS)
+    for version in versions:
+        if version not in VERSION_CONFIGS:
+            parser.error("Unknown game version: %s" % version)
+
+    feature = "debug_dyn" if args.debug else "dynamic"
+    if args.profile:
+        profiler.enable(args.profile_output)
+
+    temp_dir = tempfile.mkdtemp()
+    print(temp_dir)
+    print()
+
+    try:
+        dependency_graph = DependencyGraph()
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            if args.watch:
+                watch(
+                    versions,
+                    pool,
+                    dependency_graph,
+                    temp_dir,
+                    feature,
+                    args.batch_free_space,
+                )
+            else:
+                build(
+                    load_assemblers(versions, temp_dir, args.batch_free_space),
+                    pool,
+                    dependency_graph,
+                    temp_dir,
+                    feature,
+                    args.incremental,
+                )
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        stack_trace = traceback.format_exc()
+        error_message = str(e) + "\n\n" + stack_trace
+        print(error_message)
+        input()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Temporary files older than this can't still be being written, so prune deletes them.
+STALE_TEMP_FILE_SECONDS = 60 * 60
+
+BUILD_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".build_cache"
+)
+
+
+def hash_inputs(*inputs):
+    # Each input is length-prefixed so that moving bytes from one input to the next changes the hash.
+    hasher = hashlib.sha256()
+    for build_input in inputs:
+        if isinstance(build_input, str):
+            build_input = build_input.encode("utf-8")
+        elif isinstance(build_input, int):
+            build_input = b"%d" % build_input
+        hasher.update(b"%d:" % len(build_input))
+        hasher.update(build_input)
+    return hasher.hexdigest()
+
+
+# Hashes of files that haven't been modified since they were last hashed are reused.
+file_hashes = {}
+
+
+def hash_file(file_path):
+    file_stat = os.stat(file_path)
+    file_key = (os.path.abspath(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+    if file_key in file_hashes:
+        return file_hashes[file_key]
+
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(0x100000), b""):
+            hasher.update(block)
+    file_hashes[file_key] = hasher.hexdigest()
+    return file_hashes[file_key]
+
+
+class BuildCache:
+    # A persistent on-disk store of build outputs, addressed by a hash of everything that went into them.
+    # With max_entries set, only that many of the most recently used entries are kept, in memory and (after prune) on disk.
+
+    def __init__(self, name, cache_dir=BUILD_CACHE_DIR, max_entries=None):
+        self.dir = os.path.join(cache_dir, name)
+        os.makedirs(self.dir, exist_ok=True)
+        self.max_entries = max_entries
+        # Entries used by this process are also kept in memory, least recently used first, which saves reloading them on every rebuild in watch mode.
+        self.memory = OrderedDict()
+        self.memory_lock = threading.Lock()
+
+    def get_path(self, key):
+        return os.path.join(self.dir, key)
+
+    def remember(self, key, value):
+        # Must be called with memory_lock held.
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if self.max_entries is not None:
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, key):
+        with self.memory_lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        entry_path = self.get_path(key) + ".pickle"
+        try:
+            with open(entry_path, "rb") as f:
+                value = pickle.load(f)
+            # Mark the entry as recently used, so prune keeps it.
+            os.utime(entry_path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        with self.memory_lock:
+            self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.memory_lock:
+            self.remember(key, value)
+        # Write to a temporary file first so a concurrent or interrupted build never sees a partial entry.
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.get_path(key) + ".pickle")
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def prune(self):
+        # Deletes all but the max_entries most recently used entries on disk, along with temporary files left behind by a build that was killed mid-write.
+        # Entries this process has in memory count as the most recently used.
+        entries = []
+        for file_name in os.listdir(self.dir):
+            if file_name.endswith(".tmp"):
+                # Recent ones may belong to a build that's still running.
+                try:
+                    temp_path = self.get_path(file_name)
+                    if (
+                        time.time() - os.stat(temp_path).st_mtime
+                        > STALE_TEMP_FILE_SECONDS
+                    ):
+                        os.remove(temp_path)
+                except OSError:
+                    pass
+                continue
+            if self.max_entries is None or not file_name.endswith(".pickle"):
+                continue
+            key = file_name[: -len(".pickle")]
+            try:
+                mtime = os.stat(self.get_path(file_name)).st_mtime_ns
+            except OSError:
+                continue
+            with self.memory_lock:
+                in_memory = key in self.memory
+            entries.append((in_memory, mtime, key))
+
+        if self.max_entries is None:
+            return
+        entries.sort(reverse=True)
+        for _, _, key in entries[self.max_entries :]:
+            try:
+                os.remove(self.get_path(key) + ".pickle")
+            except OSError:
+                pass
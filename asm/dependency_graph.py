@@ -0,0 +1,48 @@
+import json
+import os
+import tempfile
+
+from build_cache import BUILD_CACHE_DIR, hash_file
+
+
+def hash_input_files(*file_paths):
+    return {
+        os.path.normpath(file_path): hash_file(file_path) for file_path in file_paths
+    }
+
+
+class DependencyGraph:
+    # Records the inputs each build output was generated from, so a later build can tell which outputs are out of date.
+    # Inputs are stored as a name -> hash mapping, where the name is a file path or a tag like "rust:static".
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(BUILD_CACHE_DIR, "dependencies.json")
+        self.path = path
+        try:
+            with open(self.path) as f:
+                self.outputs = json.load(f)
+        except (OSError, ValueError):
+            self.outputs = {}
+
+    def is_stale(self, output_path, inputs):
+        if not os.path.isfile(output_path):
+            return True
+        return self.outputs.get(os.path.normpath(output_path)) != inputs
+
+    def get_stale_outputs(self, inputs_for_outputs):
+        return [
+            output_path
+            for output_path, inputs in inputs_for_outputs.items()
+            if self.is_stale(output_path, inputs)
+        ]
+
+    def record(self, output_path, inputs):
+        self.outputs[os.path.normpath(output_path)] = inputs
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.outputs, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
@@ -1,115 +1,256 @@
 from enum import Enum
-from io import BytesIO
 from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+import mmap
+import struct
 
 from fs_helpers import *
 
 
 class ELF:
-    def read_from_file(self, file_path):
-        with open(file_path, "rb") as f:
-            self.data = BytesIO(f.read())
-
-        self.section_headers_table_offset = read_u32(self.data, 0x20)
-        self.num_section_headers = read_u16(self.data, 0x30)
+    # Reads the file through a memory map. Section data is exposed as zero-copy memoryviews into the map, so close() must be called before the file is modified.
+    # In lazy mode, relocation and symbol tables are only decoded when first accessed, and each symbol (with its name) only when first indexed. Anything not yet decoded can't be accessed after close().
 
+    def read_from_file(self, file_path, lazy=False):
+        with open(file_path, "rb") as f:
+            try:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped.
+                self.mmap = None
+        self.read(self.mmap if self.mmap is not None else b"", lazy)
+
+    def read_from_bytes(self, data, lazy=False):
+        self.mmap = None
+        self.read(data, lazy)
+
+    def read(self, data, lazy=False):
+        self.raw_data = data
+        self.data = memoryview(data)
+        self.lazy = lazy
+
+        self.section_headers_table_offset = ELF_HEADER_FORMAT.unpack_from(
+            self.data, 0x20
+        )[0]
+        self.num_section_headers, self.section_header_string_table_index = (
+            ELF_SECTION_COUNTS_FORMAT.unpack_from(self.data, 0x30)
+        )
+
+        # The section header table is small and needed to find anything else, so it's always read up front.
         self.sections = []
-        self.section_header_string_table_offset = None
-        for i in range(self.num_section_headers):
+        for i, section_header in enumerate(
+            unpack_records_from(
+                self.data,
+                self.section_headers_table_offset,
+                self.num_section_headers,
+                ELFSection.FORMAT,
+            )
+        ):
             section = ELFSection()
             section.read(
-                self.data, self.section_headers_table_offset + i * ELFSection.ENTRY_SIZE
+                self.data,
+                self.section_headers_table_offset + i * ELFSection.ENTRY_SIZE,
+                section_header,
             )
             self.sections.append(section)
 
-            if section.type == ELFSectionType.SHT_STRTAB:
-                self.section_header_string_table_offset = section.section_offset
-
+        self.section_header_string_table = StringTable(
+            self.sections[self.section_header_string_table_index].data
+        )
         for section in self.sections:
-            section.name = read_str_until_null_character(
-                self.data, self.section_header_string_table_offset + section.name_offset
-            )
+            section.name = self.section_header_string_table.get(section.name_offset)
 
         self.sections_by_name = OrderedDict()
         for section in self.sections:
             self.sections_by_name[section.name] = section
 
-        self.relocations = OrderedDict()
-        for section in self.sections:
-            if section.type == ELFSectionType.SHT_RELA:
-                self.relocations[section.name] = []
-                for i in range(section.size // ELFRelocation.ENTRY_SIZE):
-                    relocation = ELFRelocation()
-                    relocation.read(
-                        self.data, section.section_offset + i * ELFRelocation.ENTRY_SIZE
-                    )
-                    self.relocations[section.name].append(relocation)
-
-        self.symbols = OrderedDict()
-        self.symbols_by_name = OrderedDict()
-        for section in self.sections:
-            if section.type == ELFSectionType.SHT_SYMTAB:
-                self.symbols[section.name] = []
-                self.symbols_by_name[section.name] = OrderedDict()
-                for i in range(section.size // ELFSymbol.ENTRY_SIZE):
-                    symbol = ELFSymbol()
-                    symbol.read(
-                        self.data, section.section_offset + i * ELFSymbol.ENTRY_SIZE
-                    )
-                    symbol.name = self.read_string_from_table(symbol.name_offset)
-                    self.symbols[section.name].append(symbol)
-                    self.symbols_by_name[section.name][symbol.name] = symbol
+        self.string_table = None
+
+        relocation_section_names = [
+            section.name
+            for section in self.sections
+            if section.type == ELFSectionType.SHT_RELA
+        ]
+        symbol_section_names = [
+            section.name
+            for section in self.sections
+            if section.type == ELFSectionType.SHT_SYMTAB
+        ]
+        self.relocations = ELFSectionTables(
+            relocation_section_names, self.read_relocations
+        )
+        self.symbols = ELFSectionTables(symbol_section_names, self.read_symbols)
+        self.symbols_by_name = ELFSectionTables(
+            symbol_section_names, self.read_symbols_by_name
+        )
+
+        if not lazy:
+            for tables in (self.relocations, self.symbols, self.symbols_by_name):
+                for section_name in tables:
+                    tables[section_name]
+
+    def read_relocations(self, section_name):
+        section = self.sections_by_name[section_name]
+        num_relocations = section.size // ELFRelocation.ENTRY_SIZE
+
+        relocations = []
+        for i, relocation_entry in enumerate(
+            unpack_records_from(section.data, 0, num_relocations, ELFRelocation.FORMAT)
+        ):
+            relocation = ELFRelocation()
+            relocation.read(
+                section.section_offset + i * ELFRelocation.ENTRY_SIZE,
+                relocation_entry,
+            )
+            relocations.append(relocation)
+        return relocations
+
+    def read_symbols(self, section_name):
+        section = self.sections_by_name[section_name]
+        if self.lazy:
+            return ELFSymbolList(self, section)
+
+        num_symbols = section.size // ELFSymbol.ENTRY_SIZE
+        symbols = []
+        for i, symbol_entry in enumerate(
+            unpack_records_from(section.data, 0, num_symbols, ELFSymbol.FORMAT)
+        ):
+            symbol = ELFSymbol()
+            symbol.read(section.section_offset + i * ELFSymbol.ENTRY_SIZE, symbol_entry)
+            symbol.name = self.read_string_from_table(symbol.name_offset)
+            symbols.append(symbol)
+        return symbols
+
+    def read_symbols_by_name(self, section_name):
+        symbols_by_name = OrderedDict()
+        for symbol in self.symbols[section_name]:
+            symbols_by_name[symbol.name] = symbol
+        return symbols_by_name
 
     def read_string_from_table(self, string_offset):
-        offset = self.sections_by_name[".strtab"].section_offset + string_offset
-        return read_str_until_null_character(self.data, offset)
+        if self.string_table is None:
+            self.string_table = StringTable(self.sections_by_name[".strtab"].data)
+        return self.string_table.get(string_offset)
+
+    def close(self):
+        # Release every view into the map before closing it.
+        for section in self.sections:
+            section.data.release()
+        self.data.release()
+        self.raw_data = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+
+class ELFSectionTables(Mapping):
+    # Maps section names to their decoded tables, decoding each one the first time it's looked up.
+
+    def __init__(self, section_names, read_table):
+        self.section_names = section_names
+        self.read_table = read_table
+        self.tables = {}
+
+    def __getitem__(self, section_name):
+        if section_name not in self.tables:
+            if section_name not in self.section_names:
+                raise KeyError(section_name)
+            self.tables[section_name] = self.read_table(section_name)
+        return self.tables[section_name]
+
+    def __iter__(self):
+        return iter(self.section_names)
+
+    def __len__(self):
+        return len(self.section_names)
+
+
+class ELFSymbolList(Sequence):
+    # A symbol table that only unpacks the entries that are actually indexed.
+
+    def __init__(self, elf, section):
+        self.elf = elf
+        self.section = section
+        self.symbols = [None] * (section.size // ELFSymbol.ENTRY_SIZE)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        symbol = self.symbols[index]
+        if symbol is None:
+            if index < 0:
+                index += len(self.symbols)
+            symbol = ELFSymbol()
+            symbol.read(
+                self.section.section_offset + index * ELFSymbol.ENTRY_SIZE,
+                ELFSymbol.FORMAT.unpack_from(
+                    self.section.data, index * ELFSymbol.ENTRY_SIZE
+                ),
+            )
+            symbol.name = self.elf.read_string_from_table(symbol.name_offset)
+            self.symbols[index] = symbol
+        return symbol
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+ELF_HEADER_FORMAT = struct.Struct(">I")
+ELF_SECTION_COUNTS_FORMAT = struct.Struct(">HH")
 
 
 class ELFSection:
     ENTRY_SIZE = 0x28
+    FORMAT = struct.Struct(">10I")
 
-    def read(self, elf_data, header_offset):
+    def read(self, elf_data, header_offset, section_header):
         self.header_offset = header_offset
 
-        self.name_offset = read_u32(elf_data, self.header_offset + 0x00)
-        self.type = ELFSectionType(read_u32(elf_data, self.header_offset + 0x04))
-        self.flags = read_u32(elf_data, self.header_offset + 0x08)
-        self.address = read_u32(elf_data, self.header_offset + 0x0C)
-        self.section_offset = read_u32(elf_data, self.header_offset + 0x10)
-        self.size = read_u32(elf_data, self.header_offset + 0x14)
-
-        self.info = read_u32(elf_data, self.header_offset + 0x1C)
+        (
+            self.name_offset,
+            section_type,
+            self.flags,
+            self.address,
+            self.section_offset,
+            self.size,
+            _,
+            self.info,
+            _,
+            _,
+        ) = section_header
+        self.type = ELFSectionType(section_type)
 
-        self.data = BytesIO(read_bytes(elf_data, self.section_offset, self.size))
+        self.data = elf_data[self.section_offset : self.section_offset + self.size]
 
 
 class ELFRelocation:
     ENTRY_SIZE = 0xC
+    FORMAT = struct.Struct(">III")
 
-    def read(self, elf_data, offset):
+    def read(self, offset, relocation_entry):
         self.offset = offset
 
-        self.relocation_offset = read_u32(elf_data, self.offset + 0x00)
-        info = read_u32(elf_data, self.offset + 0x04)
+        self.relocation_offset, info, self.addend = relocation_entry
         self.type = ELFRelocationType(info & 0x000000FF)
         self.symbol_index = (info & 0xFFFFFF00) >> 8
-        self.addend = read_u32(elf_data, self.offset + 0x08)
 
 
 class ELFSymbol:
     ENTRY_SIZE = 0x10
+    FORMAT = struct.Struct(">IIIBBH")
 
-    def read(self, elf_data, offset):
+    def read(self, offset, symbol_entry):
         self.offset = offset
 
-        self.name_offset = read_u32(elf_data, self.offset + 0x00)
-        self.address = read_u32(elf_data, self.offset + 0x04)
-        self.size = read_u32(elf_data, self.offset + 0x08)
-        self.info = read_u8(
-            elf_data, self.offset + 0x0C
-        )  # lower nibble is type, upper is binding
-        self.other = read_u8(elf_data, self.offset + 0x0D)
-        self.section_index = read_u16(elf_data, self.offset + 0x0E)
+        (
+            self.name_offset,
+            self.address,
+            self.size,
+            self.info,  # lower nibble is type, upper is binding
+            self.other,
+            self.section_index,
+        ) = symbol_entry
 
 
 class ELFSectionType(Enum):
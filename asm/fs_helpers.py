@@ -2,6 +2,8 @@ import struct
 from io import BytesIO
 
 PADDING_BYTES = b"This is padding data to alignme"
+STR_READ_BLOCK_SIZE = 0x40
+U32_FORMAT = struct.Struct(">I")
 
 
 class InvalidOffsetError(Exception):
@@ -76,23 +78,55 @@ def read_str_until_null_character(data, offset):
             % (offset, data_length)
         )
 
-    temp_offset = offset
-    str_length = 0
-    while temp_offset < data_length:
-        data.seek(temp_offset)
-        char = data.read(1)
-        if char == b"\0":
+    # Read ahead in blocks instead of one byte at a time, and stop at the first block containing the null character.
+    data.seek(offset)
+    str_bytes = b""
+    while True:
+        block = data.read(STR_READ_BLOCK_SIZE)
+        null_index = block.find(b"\0")
+        if null_index != -1:
+            str_bytes += block[:null_index]
+            break
+        str_bytes += block
+        if len(block) < STR_READ_BLOCK_SIZE:
             break
-        else:
-            str_length += 1
-        temp_offset += 1
 
-    data.seek(offset)
-    str = data.read(str_length).decode("shift_jis")
+    str = str_bytes.decode("shift_jis")
 
     return str
 
 
+class StringTable:
+    # A block of null-terminated strings, such as an ELF string table, that strings are looked up in by offset.
+    # Each string is decoded the first time its offset is looked up, and cached after that.
+    # Pass encoding=None to get the raw bytes instead of decoded strings.
+
+    def __init__(self, data, encoding="shift_jis"):
+        self.data = bytes(data)
+        self.encoding = encoding
+        self.strings = {}
+
+    def get(self, offset):
+        string = self.strings.get(offset)
+        if string is not None:
+            return string
+
+        if offset > len(self.data):
+            raise InvalidOffsetError(
+                "Offset 0x%X is past the end of the string table (length 0x%X)."
+                % (offset, len(self.data))
+            )
+        end = self.data.find(b"\0", offset)
+        if end == -1:
+            end = len(self.data)
+        string = self.data[offset:end]
+        if self.encoding is not None:
+            string = string.decode(self.encoding)
+
+        self.strings[offset] = string
+        return string
+
+
 def write_str(data, offset, new_string, max_length):
     # Writes a fixed-length string.
     # Although it is fixed-length, it still must have a null character terminating it, so the real max length is one less than the passed max_length argument.
@@ -243,6 +277,28 @@ def write_s32(data, offset, new_value):
     data.write(new_value)
 
 
+# The following work directly on a bytes-like buffer (bytes, bytearray, memoryview, mmap) instead of a file object, so they don't need to seek.
+
+
+def unpack_u32_from(buffer, offset):
+    return U32_FORMAT.unpack_from(buffer, offset)[0]
+
+
+def pack_u32_into(buffer, offset, new_value):
+    U32_FORMAT.pack_into(buffer, offset, new_value)
+
+
+def unpack_records_from(buffer, offset, count, record_format):
+    # Returns an iterator over count consecutive records laid out as record_format (a struct.Struct).
+    end = offset + count * record_format.size
+    if end > len(buffer):
+        raise InvalidOffsetError(
+            "Offset 0x%X, length 0x%X is past the end of the data (length 0x%X)."
+            % (offset, count * record_format.size, len(buffer))
+        )
+    return record_format.iter_unpack(memoryview(buffer)[offset:end])
+
+
 def align_data_to_nearest(data, size, padding_bytes=PADDING_BYTES):
     current_end = data_len(data)
     next_offset = current_end + (size - current_end % size) % size
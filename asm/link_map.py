@@ -0,0 +1,149 @@
+import re
+from collections import OrderedDict
+
+# Everything before this heading (archive members, discarded sections, memory configuration) has no symbol addresses in it.
+MEMORY_MAP_HEADING = "Linker script and memory map"
+# Symbol and section address lines are indented to the width of the section name column.
+ADDRESS_LINE_PREFIX = " " * 16 + "0x"
+
+MAP_SYMBOL_RE = re.compile(r" +0x(?:00000000)?([0-9a-f]{8}) +([a-zA-Z]\S+)$")
+# An output section starts at the first column, an input section one space in.
+# Long names are printed on their own line, with the address and size on the next one.
+MAP_SECTION_RE = re.compile(
+    r"^( ?)([^\s*]\S*)(?:\s+0x([0-9a-f]+)\s+0x([0-9a-f]+)(?:\s+(\S.*))?)?$"
+)
+MAP_SECTION_ADDRESS_RE = re.compile(r"^ +0x([0-9a-f]+)\s+0x([0-9a-f]+)(?:\s+(\S.*))?$")
+
+
+class LinkMapSection:
+    def __init__(self, name, address, size, file_path=None):
+        self.name = name
+        self.address = address
+        self.size = size
+        # Only set for input sections.
+        self.file_path = file_path
+        self.symbols = OrderedDict()
+
+
+class LinkMap:
+    # The sections and symbols of a linker map file.
+
+    def __init__(self):
+        # Output section name -> section. Each output section also lists the input sections that went into it.
+        self.sections = OrderedDict()
+        self.input_sections = []
+        self.symbols = OrderedDict()
+
+    def get_symbols(self, section_names=None):
+        if section_names is None:
+            return self.symbols
+        symbols = OrderedDict()
+        for section_name in section_names:
+            if section_name in self.sections:
+                symbols.update(self.sections[section_name].symbols)
+        return symbols
+
+    def get_input_section_addresses(self, section_name):
+        # Returns the address of every input section with this name, in link order.
+        return [
+            input_section.address
+            for input_section in self.input_sections
+            if input_section.name == section_name
+        ]
+
+
+def read_link_map(map_name, section_names=None):
+    # Only symbols in the output sections named in section_names are collected, or all of them if it's None.
+    with open(map_name) as f:
+        map_text = f.read()
+
+    link_map = LinkMap()
+    memory_map_start = map_text.find(MEMORY_MAP_HEADING)
+    if memory_map_start == -1:
+        return link_map
+
+    output_section = None
+    input_section = None
+    pending_section = None
+    collect_symbols = False
+    for line in map_text[memory_map_start:].splitlines():
+        if line.startswith(ADDRESS_LINE_PREFIX):
+            if pending_section is not None:
+                # The address and size of the section on the previous line.
+                match = MAP_SECTION_ADDRESS_RE.match(line)
+                is_input_section, section_name = pending_section
+                pending_section = None
+                if match:
+                    output_section, input_section = add_section(
+                        link_map,
+                        output_section,
+                        input_section,
+                        is_input_section,
+                        section_name,
+                        *match.groups(),
+                    )
+                    collect_symbols = output_section is not None and (
+                        section_names is None or output_section.name in section_names
+                    )
+                    continue
+
+            if not collect_symbols:
+                continue
+            match = MAP_SYMBOL_RE.match(line)
+            if not match:
+                continue
+            symbol_address = int(match.group(1), 16)
+            symbol_name = match.group(2)
+            link_map.symbols[symbol_name] = symbol_address
+            output_section.symbols[symbol_name] = symbol_address
+            if input_section is not None:
+                input_section.symbols[symbol_name] = symbol_address
+            continue
+
+        pending_section = None
+        if line[:2] == "  " or line[:2] == " *":
+            # Input section patterns and fill.
+            continue
+        match = MAP_SECTION_RE.match(line)
+        if not match:
+            continue
+        indent, section_name, address, size, file_path = match.groups()
+        is_input_section = indent == " "
+        if address is None:
+            pending_section = (is_input_section, section_name)
+            continue
+        output_section, input_section = add_section(
+            link_map,
+            output_section,
+            input_section,
+            is_input_section,
+            section_name,
+            address,
+            size,
+            file_path,
+        )
+        collect_symbols = output_section is not None and (
+            section_names is None or output_section.name in section_names
+        )
+
+    return link_map
+
+
+def add_section(
+    link_map,
+    output_section,
+    input_section,
+    is_input_section,
+    section_name,
+    address,
+    size,
+    file_path,
+):
+    # Returns the output and input sections that following lines belong to.
+    section = LinkMapSection(section_name, int(address, 16), int(size, 16), file_path)
+    if not is_input_section:
+        link_map.sections[section_name] = section
+        return section, None
+
+    link_map.input_sections.append(section)
+    return output_section, section
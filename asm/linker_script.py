@@ -0,0 +1,59 @@
+import os
+import tempfile
+
+from build_cache import hash_inputs
+from profiler import profiler
+
+
+def get_symbols_linker_script(symbols):
+    return "".join(
+        "%s = 0x%08X;\n" % (symbol_name, symbol_address)
+        for symbol_name, symbol_address in symbols.items()
+    )
+
+
+class LinkerScriptBuilder:
+    # Builds linker scripts out of segments that are each written to disk once and then INCLUDEd.
+    # Blocks shared by many links, like the main.dol symbols, are only rendered and written a single time, and each link only adds the symbols that are new to it.
+    # Segments are all included from the top level script, since ld limits how deeply INCLUDEs can nest.
+
+    def __init__(self, temp_dir, segment_paths=(), segment_hashes=()):
+        self.temp_dir = temp_dir
+        self.segment_paths = list(segment_paths)
+        self.segment_hashes = list(segment_hashes)
+
+    def add_segment(self, text):
+        if not text:
+            return
+        with profiler.stage("linker_script", "segment"):
+            fd, segment_path = tempfile.mkstemp(
+                prefix="segment_", suffix=".ld", dir=self.temp_dir
+            )
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            self.segment_paths.append(segment_path)
+            self.segment_hashes.append(hash_inputs(text))
+
+    def add_symbols(self, symbols):
+        self.add_segment(get_symbols_linker_script(symbols))
+
+    def copy(self, temp_dir=None):
+        # Segments are never modified once written, so copies can share them.
+        # New segments and scripts go in temp_dir, which defaults to this builder's.
+        return LinkerScriptBuilder(
+            self.temp_dir if temp_dir is None else temp_dir,
+            self.segment_paths,
+            self.segment_hashes,
+        )
+
+    def get_content_hash(self):
+        # Identifies the full text of the script, independent of where its segments were written.
+        return hash_inputs(*self.segment_hashes)
+
+    def write(self, name):
+        linker_script_path = os.path.join(self.temp_dir, name + ".ld")
+        with open(linker_script_path, "w") as f, profiler.stage("linker_script", name):
+            for segment_path in self.segment_paths:
+                # ld is happiest with forward slashes, even on Windows.
+                f.write('INCLUDE "%s"\n' % segment_path.replace("\\", "/"))
+        return linker_script_path
@@ -0,0 +1,48 @@
+import re
+
+# .lst files map symbol names to where they are, one per line: "[module,section,]offset:name".
+# Entries are name -> (module id, section index, offset), where module id 0 means main.dol, which has no sections.
+# A blank or comment line matches the first alternative, with every group empty.
+LST_LINE_RE = re.compile(
+    r"^\s*(?://.*)?$"
+    r"|^(?:([a-zA-Z0-9]{1,8}),([a-zA-Z0-9]{1,8}),)?([a-zA-Z0-9]{1,8}):([^/\s]+?)(?:\s*//.*)?$"
+)
+
+
+def read_lst(lines):
+    # Yields (name, entry) for each line of a .lst file, in order. Lines that aren't entries are skipped.
+    for line in lines:
+        match = LST_LINE_RE.match(line)
+        if not match or match[4] is None:
+            continue
+        yield match[4], (
+            0 if match[1] is None else int(match[1], 16),
+            0 if match[2] is None else int(match[2], 16),
+            int(match[3], 16),
+        )
+
+
+def read_lst_file(lst_path):
+    with open(lst_path, "r") as f:
+        yield from read_lst(f)
+
+
+def format_lst_entry(name, entry):
+    module_id, section, offset = entry
+    if module_id != 0:
+        return f"0x{module_id:x},{section:d},{offset:x}:{name}\n"
+    return f"{offset:x}:{name}\n"
+
+
+def write_lst(f, symbols):
+    # Writes a mapping of name -> entry, or an iterable of (name, entry), one line at a time.
+    if hasattr(symbols, "items"):
+        symbols = symbols.items()
+    for name, entry in symbols:
+        f.write(format_lst_entry(name, entry))
+
+
+def get_lst_text(symbols):
+    if hasattr(symbols, "items"):
+        symbols = symbols.items()
+    return "".join(format_lst_entry(name, entry) for name, entry in symbols)
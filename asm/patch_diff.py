@@ -0,0 +1,80 @@
+from collections import OrderedDict
+
+import yaml
+
+# Patched bytes are stored as hex text rather than a YAML list of integers, which is several times smaller and much faster to parse.
+# Each line holds this many bytes, so diffs between builds stay readable.
+HEX_BYTES_PER_LINE = 32
+
+
+class HexData(bytes):
+    pass
+
+
+class PatchDiffDumper(yaml.CDumper):
+    pass
+
+
+def represent_hex_data(dumper, data):
+    hex_lines = [
+        data[i : i + HEX_BYTES_PER_LINE].hex().upper() + "\n"
+        for i in range(0, len(data), HEX_BYTES_PER_LINE)
+    ]
+    # Literal block scalars are always strings, so hex that happens to look like a number is never misread.
+    return dumper.represent_scalar(
+        "tag:yaml.org,2002:str", "".join(hex_lines), style="|"
+    )
+
+
+PatchDiffDumper.add_representer(HexData, represent_hex_data)
+PatchDiffDumper.add_representer(
+    OrderedDict, lambda dumper, data: dumper.represent_dict(data.items())
+)
+# Keep each relocation on a single line.
+PatchDiffDumper.add_representer(
+    list,
+    lambda dumper, data: dumper.represent_sequence(
+        "tag:yaml.org,2002:seq", data, flow_style=True
+    ),
+)
+PatchDiffDumper.add_representer(
+    int, lambda dumper, data: yaml.ScalarNode("tag:yaml.org,2002:int", "0x%02X" % data)
+)
+
+
+def dump_patch_diff(diffs):
+    # diffs maps file path -> org offset -> {"Data": bytes, "Relocations": [...]}.
+    output_diffs = OrderedDict()
+    for file_path, diffs_for_file in diffs.items():
+        output_diffs[file_path] = OrderedDict()
+        for org_offset, diff in diffs_for_file.items():
+            output_diff = OrderedDict(diff)
+            output_diff["Data"] = HexData(diff["Data"])
+            output_diffs[file_path][org_offset] = output_diff
+
+    return yaml.dump(
+        output_diffs,
+        Dumper=PatchDiffDumper,
+        default_flow_style=False,
+        line_break="\n",
+    )
+
+
+def write_patch_diff(diff_path, diffs):
+    with open(diff_path, "w") as f:
+        f.write(dump_patch_diff(diffs))
+
+
+def read_patch_diff(diff_path):
+    with open(diff_path) as f:
+        diffs = yaml.load(f, Loader=yaml.CSafeLoader)
+
+    for diffs_for_file in diffs.values():
+        for diff in diffs_for_file.values():
+            if isinstance(diff["Data"], str):
+                diff["Data"] = bytes.fromhex(diff["Data"])
+            else:
+                # Diffs written before the hex format stored a list of byte values.
+                diff["Data"] = bytes(diff["Data"])
+
+    return diffs
@@ -0,0 +1,242 @@
+import os
+import re
+from collections import OrderedDict
+
+from build_cache import hash_file
+
+# The directives handled while parsing patches, one named group each.
+# Alternatives are tried in order, so a hex .org takes priority over a symbol .org.
+PATCH_DIRECTIVE_RE = re.compile(
+    r'\.open\s+"(?P<open_file>[^"]+)"$'
+    r"|\.org\s+(?P<org_offset>0x[0-9a-f]+|@MainInjection)$"
+    r"|\.org\s+(?P<org_symbol>[\._a-z][\._a-z0-9]+|@NextFreeSpace)$"
+    r"|(?:b|beq|bne|blt|bgt|ble|bge)\s+0x(?P<branch_dest>[0-9a-f]+)(?:$|\s)",
+    re.IGNORECASE,
+)
+
+
+def strip_patch_comment(line):
+    # Removes everything from the first ; onwards, as long as something follows it.
+    comment_start = line.find(";")
+    if comment_start != -1 and comment_start < len(line) - 1:
+        return line[:comment_start]
+    return line
+
+
+def get_patch_error(patch_path, line_number, message):
+    return Exception("%s:%d: %s" % (patch_path, line_number, message))
+
+
+class OpenFileEvent:
+    def __init__(self, line_number, file_path):
+        self.line_number = line_number
+        self.file_path = file_path
+
+
+class OrgEvent:
+    def __init__(self, line_number, org):
+        self.line_number = line_number
+        # Either an offset, or a symbol such as @MainInjection or @NextFreeSpace.
+        self.org = org
+
+
+class CodeLineEvent:
+    def __init__(self, line_number, line, branch_dest=None):
+        self.line_number = line_number
+        # Branches to specific addresses have already had the address replaced with the branch_label_ for branch_dest.
+        self.line = line
+        self.branch_dest = branch_dest
+
+
+class CloseFileEvent:
+    def __init__(self, line_number):
+        self.line_number = line_number
+
+
+def get_branch_label(branch_dest):
+    return "branch_label_%X" % branch_dest
+
+
+def parse_patch_events(patch_path, asm):
+    # Yields the events in a patch's source, checking that code only appears inside an .open/.close block and after an .org.
+    most_recent_file_path = None
+    most_recent_org = None
+    line_number = 0
+    for line_number, line in enumerate(asm.splitlines(), 1):
+        line = strip_patch_comment(line).strip()
+        if not line:
+            # Blank line
+            continue
+
+        directive_match = PATCH_DIRECTIVE_RE.match(line)
+        directive = directive_match.lastgroup if directive_match else None
+        branch_dest = None
+        if directive == "open_file":
+            relative_file_path = directive_match.group("open_file")
+            if most_recent_file_path or most_recent_org is not None:
+                raise get_patch_error(
+                    patch_path,
+                    line_number,
+                    "File %s was not closed before opening new file %s."
+                    % (most_recent_file_path, relative_file_path),
+                )
+            most_recent_file_path = relative_file_path
+            yield OpenFileEvent(line_number, relative_file_path)
+            continue
+        elif directive == "org_offset" or directive == "org_symbol":
+            if not most_recent_file_path:
+                raise get_patch_error(
+                    patch_path,
+                    line_number,
+                    "Found .org directive when no file was open.",
+                )
+
+            org = directive_match.group(directive)
+            if directive == "org_offset" and org != "@MainInjection":
+                org = int(org, 16)
+            most_recent_org = org
+            yield OrgEvent(line_number, org)
+            continue
+        elif directive == "branch_dest":
+            # Replace branches to specific addresses with labels, which get defined in the linker script.
+            branch_dest_hex = directive_match.group("branch_dest")
+            branch_dest = int(branch_dest_hex, 16)
+            line = line.replace(
+                "0x" + branch_dest_hex, get_branch_label(branch_dest), 1
+            )
+        elif line == ".close":
+            most_recent_file_path = None
+            most_recent_org = None
+            yield CloseFileEvent(line_number)
+            continue
+
+        if not most_recent_file_path:
+            if line[0] == ";":
+                # Comment
+                continue
+            raise get_patch_error(
+                patch_path, line_number, "Found code when no file was open."
+            )
+        if most_recent_org is None:
+            if line[0] == ";":
+                # Comment
+                continue
+            raise get_patch_error(
+                patch_path, line_number, "Found code before any .org directive."
+            )
+
+        yield CodeLineEvent(line_number, line, branch_dest)
+
+    if most_recent_file_path or most_recent_org is not None:
+        raise get_patch_error(
+            patch_path,
+            line_number,
+            "File %s was not closed before the end of the file."
+            % most_recent_file_path,
+        )
+
+
+# Absolute patch path -> (hash of its contents, its events), so unchanged patches aren't parsed again.
+# Only the latest version of each patch is kept, so editing a patch in watch mode replaces its entry.
+patch_events_by_path = {}
+
+
+def read_patch_events(patch_path):
+    patch_key = os.path.abspath(patch_path)
+    file_hash = hash_file(patch_path)
+    cached_entry = patch_events_by_path.get(patch_key)
+    if cached_entry is not None and cached_entry[0] == file_hash:
+        return cached_entry[1]
+
+    with open(patch_path) as f:
+        asm = f.read()
+    events = list(parse_patch_events(patch_path, asm))
+    patch_events_by_path[patch_key] = (file_hash, events)
+    return events
+
+
+class PatchChunks:
+    # The code chunks of every patch for one game version, built up from parse events one patch at a time.
+    # Each @NextFreeSpace gets its own @FreeSpace_<id> symbol, numbered per file across all the patches.
+
+    def __init__(self, main_injection, free_space_start_offsets, handle_sda_instr):
+        self.main_injection = main_injection
+        self.free_space_start_offsets = free_space_start_offsets
+        self.handle_sda_instr = handle_sda_instr
+
+        # Patch name -> file path -> org offset or symbol -> code.
+        self.code_chunks = OrderedDict()
+        # File path -> addresses of local branches within that file, in the order they appear.
+        self.local_branches_for_file = OrderedDict()
+        self.next_free_space_id_for_file = {}
+
+    def add_patch(self, patch_path, events=None):
+        if events is None:
+            events = read_patch_events(patch_path)
+
+        patch_name = os.path.splitext(os.path.basename(patch_path))[0]
+        code_chunks_for_patch = OrderedDict()
+        self.code_chunks[patch_name] = code_chunks_for_patch
+
+        chunk_lines = None
+        file_path = None
+        line_number = 0
+        for event in events:
+            line_number = event.line_number
+            if isinstance(event, CodeLineEvent):
+                line = event.line
+                if event.branch_dest is not None:
+                    self.local_branches_for_file[file_path].append(event.branch_dest)
+                if "@sda21" in line:
+                    line = self.handle_sda_instr(line)
+                chunk_lines.append(line + "\n")
+            elif isinstance(event, OrgEvent):
+                org = self.get_org(patch_path, event, file_path)
+                chunk_lines = []
+                code_chunks_for_patch[file_path][org] = chunk_lines
+            elif isinstance(event, OpenFileEvent):
+                file_path = event.file_path
+                if file_path not in code_chunks_for_patch:
+                    code_chunks_for_patch[file_path] = OrderedDict()
+                if file_path not in self.local_branches_for_file:
+                    self.local_branches_for_file[file_path] = []
+            elif isinstance(event, CloseFileEvent):
+                file_path = None
+                chunk_lines = None
+
+        if not code_chunks_for_patch:
+            raise get_patch_error(patch_path, line_number, "No code found.")
+
+        for code_chunks_for_file in code_chunks_for_patch.values():
+            for org, lines in code_chunks_for_file.items():
+                code_chunks_for_file[org] = "".join(lines)
+
+    def get_org(self, patch_path, event, file_path):
+        if event.org == "@NextFreeSpace":
+            # Need to make each instance of @NextFreeSpace into a unique label.
+            if file_path not in self.next_free_space_id_for_file:
+                self.next_free_space_id_for_file[file_path] = 1
+            org = "@FreeSpace_%d" % self.next_free_space_id_for_file[file_path]
+            self.next_free_space_id_for_file[file_path] += 1
+            return org
+        elif event.org == "@MainInjection":
+            org_offset = self.main_injection
+        elif isinstance(event.org, int):
+            org_offset = event.org
+        else:
+            return event.org
+
+        if org_offset >= self.free_space_start_offsets[file_path]:
+            raise get_patch_error(
+                patch_path,
+                event.line_number,
+                'Tried to manually set the origin point to after the start of free space.\n.org offset: 0x%X\nFile path: %s\n\nUse ".org @NextFreeSpace" instead to get an automatically assigned free space offset.'
+                % (org_offset, file_path),
+            )
+        return org_offset
+
+    def get_local_branches_linker_script(self, file_path):
+        return "".join(
+            "%s = 0x%X;\n" % (get_branch_label(branch_dest), branch_dest)
+            for branch_dest in self.local_branches_for_file.get(file_path, [])
+        )
@@ -0,0 +1,201 @@
+import html
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from subprocess import call
+
+try:
+    import resource
+except ImportError:
+    # Peak memory isn't available on Windows.
+    resource = None
+
+
+def get_peak_memory():
+    # Returns the peak resident memory of this process and of the largest subprocess it waited for, in bytes.
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes, except on macOS where it's in bytes.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+
+class BuildProfiler:
+    # Times each stage of a build, per chunk, and writes a JSON and HTML report at the end.
+    # Does nothing until enabled, so the stages can be marked unconditionally.
+
+    def __init__(self):
+        self.enabled = False
+        self.report_name = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self, report_name):
+        self.enabled = True
+        self.report_name = report_name
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.events = []
+            self.subprocess_counts = OrderedDict()
+
+    @contextmanager
+    def stage(self, stage, label=""):
+        if not self.enabled:
+            yield
+            return
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            with self.lock:
+                self.events.append(
+                    OrderedDict(
+                        [
+                            ["stage", stage],
+                            ["label", label],
+                            ["start", start_time - self.start_time],
+                            ["seconds", end_time - start_time],
+                            ["thread", threading.current_thread().name],
+                        ]
+                    )
+                )
+
+    def call(self, stage, label, command, **kwargs):
+        # Runs a subprocess like subprocess.call, counting it and timing it as a stage.
+        if self.enabled:
+            with self.lock:
+                self.subprocess_counts[stage] = self.subprocess_counts.get(stage, 0) + 1
+        with self.stage(stage, label):
+            return call(command, **kwargs)
+
+    def get_report(self):
+        with self.lock:
+            events = list(self.events)
+            subprocess_counts = OrderedDict(self.subprocess_counts)
+            total_seconds = time.perf_counter() - self.start_time
+
+        stages = OrderedDict()
+        for event in events:
+            if event["stage"] not in stages:
+                stages[event["stage"]] = OrderedDict(
+                    [["count", 0], ["total_seconds", 0.0], ["max_seconds", 0.0]]
+                )
+            stage_totals = stages[event["stage"]]
+            stage_totals["count"] += 1
+            stage_totals["total_seconds"] += event["seconds"]
+            stage_totals["max_seconds"] = max(
+                stage_totals["max_seconds"], event["seconds"]
+            )
+
+        peak_memory, peak_subprocess_memory = get_peak_memory()
+        return OrderedDict(
+            [
+                ["total_seconds", total_seconds],
+                ["peak_memory_bytes", peak_memory],
+                ["peak_subprocess_memory_bytes", peak_subprocess_memory],
+                ["subprocess_counts", subprocess_counts],
+                ["stages", stages],
+                ["events", events],
+            ]
+        )
+
+    def write_report(self):
+        if not self.enabled:
+            return
+
+        report = self.get_report()
+        json_path = self.report_name + ".json"
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+        html_path = self.report_name + ".html"
+        with open(html_path, "w") as f:
+            f.write(get_report_html(report))
+
+        print("Wrote build profile to %s and %s" % (json_path, html_path))
+        print()
+
+
+def format_bytes(num_bytes):
+    if num_bytes is None:
+        return "unknown"
+    return "%.1f MiB" % (num_bytes / (1024 * 1024))
+
+
+def get_report_html(report):
+    # Stages are listed slowest first. Stages can overlap, both because they nest (parse includes the SDA rewrite) and because chunks link in parallel.
+    rows = []
+    for stage, stage_totals in sorted(
+        report["stages"].items(), key=lambda item: -item[1]["total_seconds"]
+    ):
+        rows.append(
+            "<tr><td>%s</td><td>%d</td><td>%d</td><td>%.3f</td><td>%.3f</td></tr>"
+            % (
+                html.escape(stage),
+                stage_totals["count"],
+                report["subprocess_counts"].get(stage, 0),
+                stage_totals["total_seconds"],
+                stage_totals["max_seconds"],
+            )
+        )
+    stage_rows = "\n".join(rows)
+
+    rows = []
+    for event in sorted(report["events"], key=lambda event: -event["seconds"]):
+        rows.append(
+            "<tr><td>%s</td><td>%s</td><td>%s</td><td>%.3f</td><td>%.3f</td></tr>"
+            % (
+                html.escape(event["stage"]),
+                html.escape(event["label"]),
+                html.escape(event["thread"]),
+                event["start"],
+                event["seconds"],
+            )
+        )
+    event_rows = "\n".join(rows)
+
+    return """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Build profile</title>
+<style>
+body { font-family: sans-serif; }
+table { border-collapse: collapse; margin-bottom: 2em; }
+th, td { border: 1px solid #ccc; padding: 2px 8px; text-align: left; }
+</style>
+</head>
+<body>
+<h1>Build profile</h1>
+<p>Total time: %.3f s<br>Peak memory: %s<br>Peak subprocess memory: %s</p>
+<h2>Stages</h2>
+<table>
+<tr><th>Stage</th><th>Count</th><th>Subprocesses</th><th>Total (s)</th><th>Slowest (s)</th></tr>
+%s
+</table>
+<h2>Every stage, slowest first</h2>
+<table>
+<tr><th>Stage</th><th>Chunk</th><th>Thread</th><th>Start (s)</th><th>Time (s)</th></tr>
+%s
+</table>
+</body>
+</html>
+""" % (
+        report["total_seconds"],
+        format_bytes(report["peak_memory_bytes"]),
+        format_bytes(report["peak_subprocess_memory_bytes"]),
+        stage_rows,
+        event_rows,
+    )
+
+
+profiler = BuildProfiler()
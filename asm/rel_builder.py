@@ -0,0 +1,162 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+from collections import OrderedDict
+
+from build_cache import BuildCache, hash_file, hash_inputs
+from lst_file import get_lst_text
+from profiler import profiler
+from pyelf2rel import elf_to_rel
+from relmapper import get_provided_symbols, map_rel
+
+# Bump this whenever MergedElf changes, so old cached entries are ignored.
+REL_CACHE_FORMAT = 1
+# The name map_rel gives the merged ELF's module, the same as the file it used to be written to.
+MERGED_ELF_MODULE_NAME = "dynamic-functions"
+
+AR_MAGIC = b"!<arch>\n"
+# Name, modification time, owner, group, mode, size and the end marker of each archive member.
+AR_MEMBER_HEADER = struct.Struct("16s12s6s6s8s10s2s")
+AR_MEMBER_HEADER_END = b"`\n"
+
+
+def read_archive_members(archive_data):
+    # Returns archive member name -> contents, in archive order, the same files `ar x` would extract.
+    # Handles the GNU and BSD variants of the common ar format, but not thin archives.
+    if not archive_data.startswith(AR_MAGIC):
+        raise Exception("Not an ar archive.")
+
+    members = OrderedDict()
+    long_names = b""
+    offset = len(AR_MAGIC)
+    while offset + AR_MEMBER_HEADER.size <= len(archive_data):
+        name, _, _, _, _, size, header_end = AR_MEMBER_HEADER.unpack_from(
+            archive_data, offset
+        )
+        if header_end != AR_MEMBER_HEADER_END:
+            raise Exception("Invalid ar member header at offset 0x%X." % offset)
+        offset += AR_MEMBER_HEADER.size
+        size = int(size)
+        member_data = archive_data[offset : offset + size]
+        # Members are aligned to 2 bytes.
+        offset += size + (size & 1)
+
+        name = name.rstrip(b" ")
+        if name == b"/" or name == b"/SYM64/":
+            # Symbol index
+            continue
+        elif name == b"//":
+            # GNU long name table, referenced by the members after it
+            long_names = member_data
+            continue
+        elif name.startswith(b"#1/"):
+            # BSD long name, stored at the start of the member's data
+            name_length = int(name[3:])
+            name = member_data[:name_length].rstrip(b"\0")
+            member_data = member_data[name_length:]
+            if name.startswith(b"__.SYMDEF"):
+                continue
+        elif name.startswith(b"/"):
+            name_start = int(name[1:])
+            name = long_names[name_start : long_names.index(b"\n", name_start)]
+
+        # Later members overwrite earlier ones with the same name, as they do with `ar x`.
+        members[name.rstrip(b"/").decode("utf-8")] = bytes(member_data)
+
+    return members
+
+
+class MergedElf:
+    # The relocatable ELF that all of a REL's objects are merged into, and the symbols it provides.
+
+    def __init__(self, data, symbols):
+        self.data = data
+        # (name, section, offset) tuples, in symbol table order.
+        self.symbols = symbols
+
+
+class RelBuilder:
+    # Builds RELs in-process, from archive members held in memory.
+    # The merged ELF and its symbols are cached along with the hash of the archive, so a REL can be rebuilt for new main.dol symbols without extracting or linking anything.
+
+    def __init__(self, ld_path, merge_linker_script, toolchain_version):
+        self.ld_path = ld_path
+        self.merge_linker_script = merge_linker_script
+        self.toolchain_version = toolchain_version
+        self.cache = BuildCache("rel")
+
+    def get_content_key(self, archive_path):
+        return hash_inputs(
+            hash_file(archive_path),
+            hash_file(self.merge_linker_script),
+            self.toolchain_version,
+        )
+
+    def get_merged_archive(self, archive_path, temp_dir, features):
+        # Only the most recent merged ELF for each set of features is kept, the same as for the rust libraries.
+        # Each one is several megabytes, so a new archive replaces the old entry rather than adding another one.
+        cache_key = hash_inputs(REL_CACHE_FORMAT, features)
+        content_key = self.get_content_key(archive_path)
+        cached_entry = self.cache.get(cache_key)
+        if cached_entry is not None:
+            cached_content_key, merged_elf = cached_entry
+            if cached_content_key == content_key:
+                return merged_elf
+
+        with open(archive_path, "rb") as f, profiler.stage("ar_read", archive_path):
+            members = read_archive_members(f.read())
+        merged_elf = self.merge_members(members, temp_dir)
+        self.cache.put(cache_key, (content_key, merged_elf))
+        return merged_elf
+
+    def merge_members(self, members, temp_dir):
+        # Links archive member name -> contents into one relocatable ELF with merge.ld.
+        # ld can only read files, so the members are written to a directory of their own first.
+        objects_dir = tempfile.mkdtemp(prefix="rel_objects", dir=temp_dir)
+        command = [
+            self.ld_path,
+            "-r",
+            "-T",
+            self.merge_linker_script,
+            "-o",
+            os.path.join(objects_dir, "merged.o"),
+        ]
+        for name, member_data in members.items():
+            if not name.endswith(".o"):
+                continue
+            object_path = os.path.join(objects_dir, os.path.basename(name))
+            with open(object_path, "wb") as f:
+                f.write(member_data)
+            command.append(object_path)
+
+        if result := profiler.call("ld", "merge_rel", command):
+            raise Exception("Linker call failed.")
+
+        with open(os.path.join(objects_dir, "merged.o"), "rb") as f:
+            data = f.read()
+        # Everything needed is in memory now, so don't leave a copy of every object behind for each build.
+        shutil.rmtree(objects_dir)
+        with profiler.stage("rel_symbols", "merge_rel"):
+            symbols = get_provided_symbols(io.BytesIO(data))
+        return MergedElf(data, symbols)
+
+
+def build_rel(module_id, merged_elf, lst_symbols):
+    # Returns the REL for a merged ELF, with its relocations against lst_symbols and its own symbols resolved.
+    # This is what map_rel and elf_to_rel do with .lst files, without going through any files.
+    dyn_symbols = map_rel(
+        None,
+        None,
+        None,
+        0,
+        [],
+        input_symbols=lst_symbols,
+        elf_symbols={MERGED_ELF_MODULE_NAME: merged_elf.symbols},
+    )
+    return elf_to_rel(
+        module_id,
+        io.BytesIO(merged_elf.data),
+        io.StringIO(get_lst_text(dyn_symbols)),
+    )
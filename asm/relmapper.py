@@ -5,6 +5,9 @@ Extracts symbol data from relocatable ELF files.
 """
 
 import argparse
+from array import array
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from enum import IntEnum
 from io import BufferedReader
@@ -15,6 +18,9 @@ import struct
 import sys
 from typing import ByteString, ClassVar, List, Union
 
+from fs_helpers import StringTable
+from lst_file import read_lst_file, write_lst
+
 __author__ = "kipcode66"
 __copyright__ = "Copyright 2022, kipcode66"
 __credits__ = ["kipcode66"]
@@ -173,6 +179,50 @@ class ELFSymbol:
         return SymbolType(t) if t < len(SymbolType) else t
 
 
+class ELFSymbolTable(Sequence):
+    # A symbol table stored as one array per field, unpacked from the whole .symtab at once.
+    # Names are only looked up when asked for, and indexing builds an ELFSymbol on demand.
+
+    def __init__(self, data: bytes, entsize: int, st_format: struct.Struct, strtab):
+        count = len(data) // entsize
+        if entsize == st_format.size:
+            entries = st_format.iter_unpack(data[: count * entsize])
+        else:
+            entries = (st_format.unpack_from(data, i * entsize) for i in range(count))
+        columns = tuple(zip(*entries)) or ((),) * 6
+        # 64-bit tables need wider value and size columns.
+        address_type = "I" if st_format.size <= 16 else "Q"
+        self.st_name = array("I", columns[0])
+        self.st_value = array(address_type, columns[1])
+        self.st_size = array(address_type, columns[2])
+        self.st_info = array("B", columns[3])
+        self.st_other = array("B", columns[4])
+        self.st_shndx = array("H", columns[5])
+        self.strtab = strtab
+
+    def __len__(self):
+        return len(self.st_name)
+
+    def get_name(self, idx: int) -> bytes:
+        return self.strtab.get(self.st_name[idx])
+
+    def get_type(self, idx: int) -> Union[SymbolType, int]:
+        t = self.st_info[idx] & 0xF
+        return SymbolType(t) if t < len(SymbolType) else t
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return ELFSymbol(
+            self.get_name(idx),
+            self.st_value[idx],
+            self.st_size[idx],
+            self.st_info[idx],
+            self.st_other[idx],
+            self.st_shndx[idx],
+        )
+
+
 class DataFormat(IntEnum):
     L32 = 0
     L64 = 1
@@ -231,13 +281,13 @@ class ELFFile:
             DataFormat.B32: ELFSectionHeader.FORMAT_B32,
             DataFormat.B64: ELFSectionHeader.FORMAT_B64,
         }
+        sh_format = sh_formats[data_format]
+        reader.seek(self.header.e_shoff)
+        sh_table = reader.read(self.header.e_shnum * self.header.e_shentsize)
         self.sections: List[ELFSectionHeader] = []
         for i in range(self.header.e_shnum):
-            reader.seek(self.header.e_shoff + i * self.header.e_shentsize)
             sh_header = ELFSectionHeader(
-                *sh_formats[data_format].unpack(
-                    reader.read(sh_formats[data_format].size)
-                )
+                *sh_format.unpack_from(sh_table, i * self.header.e_shentsize)
             )
             if sh_header.sh_type < SectionHeaderType.NUM:
                 sh_header.sh_type = SectionHeaderType(sh_header.sh_type)
@@ -245,7 +295,7 @@ class ELFFile:
         # load main name table
         reader.seek(self.sections[self.header.e_shstrndx].sh_offset)
         section_str_table = reader.read(self.sections[self.header.e_shstrndx].sh_size)
-        self.shstr = section_str_table
+        self.shstr = StringTable(section_str_table, encoding=None)
         # Set section names
         for section in self.sections:
             section.sh_name = self._get_shstr(section.sh_name)
@@ -253,7 +303,7 @@ class ELFFile:
         strtab = self.get_section_by_name(b".strtab")
         reader.seek(strtab.sh_offset)
         strtab = reader.read(strtab.sh_size)
-        self.strtab = strtab
+        self.strtab = StringTable(strtab, encoding=None)
 
         # Get the symbol table
         symtab_idx = self.get_section_idx(b".symtab")
@@ -264,26 +314,19 @@ class ELFFile:
             DataFormat.B32: ELFSymbol.FORMAT_B32,
             DataFormat.B64: ELFSymbol.FORMAT_B64,
         }
-        self.symbols: List[ELFSymbol] = []
-        for i in range(symtab.sh_size // symtab.sh_entsize):
-            reader.seek(symtab.sh_offset + i * symtab.sh_entsize)
-            sym = ELFSymbol(
-                *st_formats[data_format].unpack(reader.read(symtab.sh_entsize))
-            )
-            sym.st_name = self._get_str(sym.st_name)
-            self.symbols.append(sym)
+        reader.seek(symtab.sh_offset)
+        self.symbols = ELFSymbolTable(
+            reader.read(symtab.sh_size),
+            symtab.sh_entsize,
+            st_formats[data_format],
+            self.strtab,
+        )
 
     def _get_str(self, idx: int):
-        c = 0
-        while self.strtab[idx + c] != 0 and c + idx < len(self.strtab):
-            c += 1
-        return self.strtab[idx : idx + c]
+        return self.strtab.get(idx)
 
     def _get_shstr(self, idx: int):
-        c = 0
-        while self.shstr[idx + c] != 0 and c + idx < len(self.shstr):
-            c += 1
-        return self.shstr[idx : idx + c]
+        return self.shstr.get(idx)
 
     def get_section_by_name(self, name: ByteString):
         ret = None
@@ -302,47 +345,96 @@ class ELFFile:
         return ret
 
 
+EXCLUDED_ENTRIES = [
+    "^_prolog$",
+    "^_epilog$",
+    "^_unresolved$",
+    "^_ZN4tpgz7modules4mainEv$",
+    "^_ZN4tpgz7modules4exitEv$",
+    r"^_rest(?:g|f)pr_[a-zA-Z0-9_]*_x$",
+    r"^_(?:c|d)tors_(?:start|end)$",
+    r"^__(?:s?bss|stack)_(?:start|end)$",
+    r"^_e(?:data|nd)$",
+]
+# Entries that only match one exact name are looked up in a set, and the rest are combined into one regex.
+EXCLUDED_NAMES = frozenset(
+    entry[1:-1]
+    for entry in EXCLUDED_ENTRIES
+    if re.fullmatch(r"\^[a-zA-Z0-9_]+\$", entry)
+)
+EXCLUDED_ENTRIES_RE = re.compile(
+    "|".join(
+        "(?:%s)" % entry
+        for entry in EXCLUDED_ENTRIES
+        if not re.fullmatch(r"\^[a-zA-Z0-9_]+\$", entry)
+    )
+)
+
+
+def is_excluded_entry(name: str):
+    return name in EXCLUDED_NAMES or EXCLUDED_ENTRIES_RE.search(name) is not None
+
+
+def get_module_name(elf_file: str) -> str:
+    file_name = os.path.splitext(os.path.basename(elf_file))
+    while file_name[1]:
+        file_name = os.path.splitext(file_name[0])
+    return file_name[0]
+
+
+def read_provided_symbols(elf_file: str) -> List[tuple]:
+    # Returns the symbols an ELF file provides as (name, section, offset) tuples, in symbol table order.
+    # Only plain tuples are returned so that this can run in a worker process.
+    with open(elf_file, "rb") as f:
+        return get_provided_symbols(f)
+
+
+def get_provided_symbols(reader) -> List[tuple]:
+    # The same as read_provided_symbols, for an ELF file that's already open or in memory.
+    elf = ELFFile(reader)
+
+    def skip_symbol_predicate(symbols: ELFSymbolTable, idx: int, name: str):
+        if is_excluded_entry(name):
+            return True
+        st_shndx = symbols.st_shndx[idx]
+        if st_shndx == SHID.UND or st_shndx >= len(elf.sections):
+            return True
+        if symbols.st_size[idx] == 0:
+            # Labels without a size are kept, as long as they have a name.
+            return not (symbols.get_type(idx) is SymbolType.NOTYPE and name)
+        return False
+
+    provided_symbols = []
+    symbols = elf.symbols
+    for idx in range(len(symbols)):
+        name = str(symbols.get_name(idx), encoding="utf-8")
+        if skip_symbol_predicate(symbols, idx, name):
+            continue
+        provided_symbols.append((name, symbols.st_shndx[idx], symbols.st_value[idx]))
+    return provided_symbols
+
+
 def map_rel(
     output_lst: str,
     config_file: str,
     input_lst: str,
     start_id: int,
     elf_files: list[str],
+    jobs: int = None,
+    input_symbols: dict = None,
+    elf_symbols: dict = None,
 ):
-    EXCLUDED_ENTRIES = [
-        "^_prolog$",
-        "^_epilog$",
-        "^_unresolved$",
-        "^_ZN4tpgz7modules4mainEv$",
-        "^_ZN4tpgz7modules4exitEv$",
-        r"^_rest(?:g|f)pr_[a-zA-Z0-9_]*_x$",
-        r"^_(?:c|d)tors_(?:start|end)$",
-        r"^__(?:s?bss|stack)_(?:start|end)$",
-        r"^_e(?:data|nd)$",
-    ]
+    # Returns the symbol map written to output_lst, which can be None to only get the map.
+    # elf_symbols maps module names to the symbols of ELF files that have already been read (see get_provided_symbols), which come after elf_files.
     provided_lst = {}
 
-    # Load the provided lst file (if needed)
+    # Load the provided symbols, either already in memory or from an lst file (if needed)
+    if not input_symbols is None:
+        for name, entry in input_symbols.items():
+            provided_lst.setdefault(name, entry)
     if not input_lst is None:
-        with open(input_lst, "r") as f:
-            for line in f:
-                m = re.match(r"^\s*(?://.*)?$", line)
-                if m:
-                    # Comment line, skip
-                    continue
-                m = re.match(
-                    r"^(?:([a-zA-Z0-9]{1,8}),([a-zA-Z0-9]{1,8}),)?([a-zA-Z0-9]{1,8}):([^/\s]+?)(?:\s*//.*)?$",
-                    line,
-                )
-                if m:
-                    provided_lst.setdefault(
-                        m[4],
-                        (
-                            0 if m[1] is None else int(m[1], 16),
-                            0 if m[2] is None else int(m[2], 16),
-                            int(m[3], 16),
-                        ),
-                    )
+        for name, entry in read_lst_file(input_lst):
+            provided_lst.setdefault(name, entry)
 
     module_ids = {}
     # Load module ids
@@ -352,54 +444,38 @@ def map_rel(
 
     curr_id = start_id
 
-    def skip_symbol_predicate(symbol: ELFSymbol):
-        if any(
-            not re.search(excluded, str(symbol.st_name, encoding="utf-8")) is None
-            for excluded in EXCLUDED_ENTRIES
-        ):
-            return True
-        if symbol.st_shndx == SHID.UND or symbol.st_shndx >= len(elf.sections):
-            return True
-        if (
-            symbol.st_size == 0
-            and symbol.get_type() is SymbolType.NOTYPE
-            and symbol.st_name
-        ):
-            return False
-        if symbol.st_size == 0:
-            return True
-        return False
+    # Each ELF file is read in its own process when there's more than one.
+    # The results come back in the order of elf_files, so module ids and which duplicate symbol wins don't depend on scheduling.
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(elf_files))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            symbols_for_files = list(pool.map(read_provided_symbols, elf_files))
+    else:
+        symbols_for_files = [read_provided_symbols(elf_file) for elf_file in elf_files]
+
+    symbols_for_modules = [
+        (get_module_name(elf_file), provided_symbols)
+        for elf_file, provided_symbols in zip(elf_files, symbols_for_files)
+    ]
+    if not elf_symbols is None:
+        symbols_for_modules += elf_symbols.items()
 
-    for elf_file in elf_files:
-        with open(elf_file, "rb") as f:
-            elf = ELFFile(f)
-            file_name = os.path.splitext(os.path.basename(elf_file))
-            while file_name[1]:
-                file_name = os.path.splitext(file_name[0])
-            file_name = file_name[0]
-            if not file_name in module_ids:
-                module_ids.setdefault(file_name, curr_id)
-                curr_id += 1
-            for symbol in elf.symbols:
-                if skip_symbol_predicate(symbol):
-                    continue
-                provided_lst.setdefault(
-                    str(symbol.st_name, encoding="utf-8"),
-                    (module_ids[file_name], symbol.st_shndx, symbol.st_value),
-                )
+    for file_name, provided_symbols in symbols_for_modules:
+        if not file_name in module_ids:
+            module_ids.setdefault(file_name, curr_id)
+            curr_id += 1
+        module_id = module_ids[file_name]
+        for name, st_shndx, st_value in provided_symbols:
+            provided_lst.setdefault(name, (module_id, st_shndx, st_value))
 
-    # Output lst file
-    with open(output_lst, "w") as f:
-        f.writelines(
-            [
-                (
-                    f"0x{t[0]:x},{t[1]:d},{t[2]:x}:{name}\n"
-                    if t[0] != 0
-                    else f"{t[2]:x}:{name}\n"
-                )
-                for name, t in provided_lst.items()
-            ]
-        )
+    # Output lst file (if needed)
+    if not output_lst is None:
+        with open(output_lst, "w") as f:
+            write_lst(f, provided_lst)
+
+    return provided_lst
 
 
 def main():
@@ -437,6 +513,13 @@ def main():
         "-i", "--input-lst", type=parseInputLstFile, help="Path to the input file"
     )
     parser.add_argument("-s", "--start-id", type=int, default=0x1000)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes to read the ELF files with (defaults to the CPU count)",
+    )
     parser.add_argument(
         "elf",
         type=parseInputElfFile,
@@ -446,7 +529,12 @@ def main():
     args = parser.parse_args()
 
     map_rel(
-        args.output_lst, args.input_modules, args.input_lst, args.start_id, args.elf
+        args.output_lst,
+        args.input_modules,
+        args.input_lst,
+        args.start_id,
+        args.elf,
+        args.jobs,
     )
 
 
@@ -0,0 +1,113 @@
+import glob
+import os
+import shutil
+import threading
+
+from build_cache import BuildCache, hash_inputs, hash_file
+from profiler import profiler
+
+RUST_TARGET = "powerpc-unknown-eabi"
+
+# Everything besides src/ that changes what cargo builds.
+# The toolchain is pinned to a dated nightly in rust-toolchain.toml, so hashing that file covers the compiler version too.
+CRATE_CONFIG_FILES = [
+    "Cargo.toml",
+    "Cargo.lock",
+    ".cargo/config.toml",
+    "powerpc-unknown-eabi.json",
+    "rust-toolchain.toml",
+]
+
+
+def fingerprint_rust_crate(crate_dir, features):
+    inputs = [features]
+    source_paths = glob.glob(os.path.join(crate_dir, "src", "**", "*"), recursive=True)
+    config_paths = [os.path.join(crate_dir, name) for name in CRATE_CONFIG_FILES]
+    for file_path in sorted(source_paths) + config_paths:
+        if not os.path.isfile(file_path):
+            continue
+        inputs += [
+            os.path.relpath(file_path, crate_dir).replace(os.sep, "/"),
+            hash_file(file_path),
+        ]
+    return hash_inputs(*inputs)
+
+
+class RustBuilder:
+    # Builds the custom functions crate, skipping cargo entirely when the crate hasn't changed since a previous build with the same features.
+    # Each built library is copied out of cargo's target directory, since static and dynamic builds overwrite the same output file.
+
+    def __init__(self, crate_dir):
+        self.crate_dir = crate_dir
+        self.cache = BuildCache("rust")
+        self.built_libraries = {}
+        # Builds from different threads share cargo's target directory, so only one may run at a time.
+        self.lock = threading.Lock()
+
+    def get_library_path(self, features, fingerprint):
+        return self.cache.get_path("%s-%s.a" % (features, fingerprint))
+
+    def find_built_library(self, features):
+        fingerprint = fingerprint_rust_crate(self.crate_dir, features)
+        if fingerprint in self.built_libraries:
+            return self.built_libraries[fingerprint]
+
+        library_path = self.get_library_path(features, fingerprint)
+        if os.path.isfile(library_path):
+            print(
+                "Rust functions (%s) are unchanged, reusing %s"
+                % (features, library_path)
+            )
+            print()
+            self.built_libraries[fingerprint] = library_path
+            return library_path
+
+        return None
+
+    def build(self, features, format_sources=False):
+        with self.lock:
+            return self.build_locked(features, format_sources)
+
+    def build_locked(self, features, format_sources):
+        library_path = self.find_built_library(features)
+        if library_path:
+            return library_path
+
+        if format_sources:
+            if result := profiler.call(
+                "cargo_fmt", features, ["cargo", "fmt"], cwd=self.crate_dir
+            ):
+                raise Exception("Formatting rust functions failed.")
+            # Formatting may have changed the sources.
+            library_path = self.find_built_library(features)
+            if library_path:
+                return library_path
+
+        fingerprint = fingerprint_rust_crate(self.crate_dir, features)
+        if result := profiler.call(
+            "cargo_build",
+            features,
+            ["cargo", "build", "--features", features, "--release"],
+            cwd=self.crate_dir,
+        ):
+            raise Exception("Building rust %s functions failed." % features)
+
+        # Only the most recent build for each set of features is kept around.
+        for old_library_path in glob.glob(self.get_library_path(features, "*")):
+            os.remove(old_library_path)
+
+        library_path = self.get_library_path(features, fingerprint)
+        temp_library_path = library_path + ".tmp"
+        shutil.copyfile(
+            os.path.join(
+                self.crate_dir,
+                "target",
+                RUST_TARGET,
+                "release",
+                "libcustom_functions.a",
+            ),
+            temp_library_path,
+        )
+        os.replace(temp_library_path, library_path)
+        self.built_libraries[fingerprint] = library_path
+        return library_path
@@ -0,0 +1,66 @@
+import os
+
+import yaml
+
+from build_cache import BuildCache, hash_file, hash_inputs
+
+# Bump this whenever SymbolTable changes, so old compiled tables are ignored.
+SYMBOL_STORE_FORMAT = 2
+
+symbol_cache = BuildCache("symbols")
+
+
+class SymbolTable:
+    # A compiled symbols file (original_symbols/<ver>.txt or custom_symbols/<ver>.txt).
+    # Lookups in both directions and the linker script for each file are all prepared up front.
+
+    def __init__(self, symbols):
+        # file path -> symbol name -> address, in the order they appear in the symbols file.
+        self.symbols = symbols
+
+        self.names_by_address = {}
+        self.linker_scripts = {}
+        for file_path, symbols_for_file in self.symbols.items():
+            names_by_address = {}
+            for symbol_name, address in symbols_for_file.items():
+                names_by_address.setdefault(address, symbol_name)
+            self.names_by_address[file_path] = names_by_address
+
+            self.linker_scripts[file_path] = "".join(
+                f"{symbol_name} = 0x{address:X};\n"
+                for symbol_name, address in symbols_for_file.items()
+            )
+
+    def get_symbols(self, file_path):
+        return self.symbols.get(file_path, {})
+
+    def get_address(self, file_path, symbol_name):
+        return self.symbols[file_path][symbol_name]
+
+    def get_name(self, file_path, address):
+        return self.names_by_address[file_path].get(address)
+
+    def get_linker_script(self, file_path):
+        return self.linker_scripts.get(file_path, "")
+
+
+def load_symbol_table(symbols_path):
+    # Parsing the symbols YAML is slow, so the compiled table is cached.
+    # The cached table is reused while the file's mtime and size are unchanged, or if its contents hash the same.
+    file_stat = os.stat(symbols_path)
+    stat_key = (file_stat.st_mtime_ns, file_stat.st_size)
+    cache_key = hash_inputs(SYMBOL_STORE_FORMAT, os.path.abspath(symbols_path))
+
+    cached_entry = symbol_cache.get(cache_key)
+    if cached_entry is not None:
+        cached_stat_key, cached_hash, symbol_table = cached_entry
+        if cached_stat_key == stat_key:
+            return symbol_table
+        if cached_hash == hash_file(symbols_path):
+            symbol_cache.put(cache_key, (stat_key, cached_hash, symbol_table))
+            return symbol_table
+
+    with open(symbols_path, "r") as f:
+        symbol_table = SymbolTable(yaml.load(f, Loader=yaml.CSafeLoader))
+    symbol_cache.put(cache_key, (stat_key, hash_file(symbols_path), symbol_table))
+    return symbol_table
@@ -1,16 +1,14 @@
-import yaml
-import os
+from collections import OrderedDict
 
+from symbol_store import load_symbol_table
 
-def create_lst(ver: str, dir: str):
-    with open(f"original_symbols/{ver}.txt", "r") as f:
-        original_symbols: dict = yaml.safe_load(f)
 
-    with open(f"custom_symbols/{ver}.txt", "r") as f:
-        custom_symbols: dict = yaml.safe_load(f)
-
-    with open(os.path.join(dir, f"{ver}.lst"), "w") as outf:
-        for symbol, addr in original_symbols["main.dol"].items():
-            outf.write(f"{hex(addr)[2:]}:{symbol}\n")
-        for symbol, addr in custom_symbols["main.dol"].items():
-            outf.write(f"{hex(addr)[2:]}:{symbol}\n")
+def get_lst_symbols(ver: str):
+    # The main.dol symbols a REL can be linked against, as a map of .lst entries for build_rel.
+    # Original symbols come first, so they win over custom symbols with the same name.
+    lst_symbols = OrderedDict()
+    for symbols_path in (f"original_symbols/{ver}.txt", f"custom_symbols/{ver}.txt"):
+        symbol_table = load_symbol_table(symbols_path)
+        for symbol_name, address in symbol_table.get_symbols("main.dol").items():
+            lst_symbols.setdefault(symbol_name, (0, 0, address))
+    return lst_symbols
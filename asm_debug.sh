@@ -1,4 +1,3 @@
 cd asm
-python3 assemble_us.py debug
-python3 assemble_jp.py debug
+python3 assemble.py --debug
 cd ..
\ No newline at end of file
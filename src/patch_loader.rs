@@ -1,5 +1,5 @@
 use include_dir::{Dir, include_dir};
-use serde::Deserialize;
+use serde::{Deserialize, Deserializer, de::Error};
 use std::collections::HashMap; // Why is this one directory higher than include_bytes / include_str???
 
 use crate::iso_tools::GameVersion;
@@ -31,10 +31,35 @@ pub struct PatchData {
 
 #[derive(Debug, Deserialize)]
 struct PatchDiffEntry {
-    #[serde(rename = "Data")]
+    #[serde(rename = "Data", deserialize_with = "deserialize_hex_data")]
     data: Box<[u8]>,
 }
 
+// Patch bytes are stored as lines of hex digits (see asm/patch_diff.py)
+fn deserialize_hex_data<'de, D>(deserializer: D) -> Result<Box<[u8]>, D::Error>
+where
+    D: Deserializer<'de>,
+{
+    let hex_str = String::deserialize(deserializer)?;
+    let hex_digits: Vec<u8> = hex_str
+        .bytes()
+        .filter(|c| !c.is_ascii_whitespace())
+        .collect();
+    if hex_digits.len() % 2 != 0 {
+        return Err(D::Error::custom(
+            "Patch data must have an even number of hex digits.",
+        ));
+    }
+
+    hex_digits
+        .chunks(2)
+        .map(|pair| {
+            let pair = std::str::from_utf8(pair).map_err(D::Error::custom)?;
+            u8::from_str_radix(pair, 16).map_err(D::Error::custom)
+        })
+        .collect()
+}
+
 #[derive(Deserialize, Debug)]
 struct FullPatchList(pub HashMap<String, PatchDiffMapRaw>);
 